@@ -11,11 +11,11 @@
 # It can also be used as a script to just save the data to a file.
 
 import argparse
-import json
 import locale
 import os
 from datetime import datetime
 
+import orjson
 import pandas as pd
 import requests
 import shapely.geometry
@@ -62,8 +62,9 @@ def get_locations(filepath):
                 os.makedirs(DATA_DIR)
             with open(local_file, 'wb') as f:
                 f.write(response.content)
-    with open(local_file, encoding='utf8') as f:
-        features = pd.Series(json.load(f)['features'])
+    # orjson parses the (large) geojson file several times faster than the json module
+    with open(local_file, 'rb') as f:
+        features = pd.Series(orjson.loads(f.read())['features'])
 
     # Flatten the json structure
     normalized = pd.json_normalize(features)
@@ -90,8 +91,7 @@ def get_locations(filepath):
     df_geojson.loc[df_geojson['street_selection'] != 'does not exist', 'street_selection'] = 'All Streets'
 
     # Remove segments w/o street name
-    nan_rows = df_geojson[df_geojson['osm.name'].isnull()]
-    return df_geojson.drop(nan_rows.index)
+    return df_geojson[df_geojson['osm.name'].notna()]
 
 
 def _read_csv(start_year=None, start_month=None, end_year=None, end_month=None, verbose=False):
@@ -108,35 +108,58 @@ def _read_csv(start_year=None, start_month=None, end_year=None, end_month=None,
         year, month = common.add_month(1, year, month)
     if verbose:
         print('Getting traffic data files...')
-    df = pd.concat((pd.read_csv(f) for f in all_files), ignore_index=True)
+    # The pyarrow engine parses the csv files with multiple threads
+    df = pd.concat((pd.read_csv(f, engine='pyarrow') for f in all_files), ignore_index=True)
 
-    # Change date_local to datetime
-    df['date_local'] = pd.to_datetime(df['date_local'])
+    # Change date_local to datetime, pyarrow may already have parsed it, but with second resolution
+    df['date_local'] = pd.to_datetime(df['date_local']).astype('datetime64[us]')
     return df
 
 def add_date_columns(traffic_df, verbose):
     if verbose:
         print('Break down date_local to new columns...')
+    # There are far less distinct (hourly) timestamps than rows, so format each timestamp only once
+    date_codes, dates = pd.factorize(traffic_df['date_local'], use_na_sentinel=False)
+    dates = pd.DatetimeIndex(dates)
+
+    def format_dates(date_format):
+        return dates.strftime(date_format).to_numpy()[date_codes]
+
     locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
-    traffic_df['year'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%Y')
-    traffic_df['Monat'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%b')
-    traffic_df['jahr_monat'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%b %Y')
-    traffic_df['year_week'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%V-%G')
-    traffic_df['Wochentag'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%a')
-    traffic_df['date'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%d-%m-%Y')
-    traffic_df['date_hour'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%d-%m-%y - %H')
-    traffic_df['day'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%d')
+    traffic_df['year'] = format_dates('%Y')
+    traffic_df['Monat'] = format_dates('%b')
+    traffic_df['jahr_monat'] = format_dates('%b %Y')
+    traffic_df['year_week'] = format_dates('%V-%G')
+    traffic_df['Wochentag'] = format_dates('%a')
+    traffic_df['date'] = format_dates('%d-%m-%Y')
+    traffic_df['date_hour'] = format_dates('%d-%m-%y - %H')
+    traffic_df['day'] = format_dates('%d')
     traffic_df.insert(0, 'hour', traffic_df['date_local'].dt.hour)
 
     locale.setlocale(locale.LC_ALL, 'en_GB.UTF-8')
-    traffic_df['month'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%b')
-    traffic_df['weekday'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%a')
-    traffic_df['year_month'] = pd.to_datetime(traffic_df.date_local).dt.strftime('%b %Y')
+    traffic_df['month'] = format_dates('%b')
+    traffic_df['weekday'] = format_dates('%a')
+    traffic_df['year_month'] = format_dates('%b %Y')
+
+
+def set_column_types(traffic_df):
+    # Use compact column types, float32 holds the hourly counts exactly (strings are dictionary encoded anyway).
+    # Speeds and uptime stay double, the charts round their averages and compare uptime to thresholds like 0.7
+    for col in ['ped_total', 'bike_total', 'car_total', 'heavy_total']:
+        traffic_df[col] = traffic_df[col].astype('float32')
+    traffic_df['hardware_version'] = traffic_df['hardware_version'].astype('Int8')
+    traffic_df['hour'] = traffic_df['hour'].astype('int8')
 
 
 def merge_data(locations, cache_file=os.path.join(DATA_DIR, 'traffic_df_2024_Q4_2025_YTD.csv.gz'), traffic_data=None, verbose=False):
-    if cache_file and os.path.exists(cache_file):
-        return pd.read_csv(cache_file)
+    if cache_file:
+        # A parquet copy of the cache (e.g. written with save_df) keeps the column types, so prefer it over parsing the csv,
+        # unless the csv has been rewritten since
+        parquet_file = cache_file.removesuffix('.gz').removesuffix('.csv').removesuffix('.parquet') + '.parquet'
+        if os.path.exists(parquet_file) and (not os.path.exists(cache_file) or os.path.getmtime(parquet_file) >= os.path.getmtime(cache_file)):
+            return pd.read_parquet(parquet_file)
+        if os.path.exists(cache_file):
+            return pd.read_csv(cache_file)
     if traffic_data is None:
         traffic_data = _read_csv(verbose=verbose)
     ### Merge traffic data with geojson information, select columns, define data formats and add date_time columns
@@ -147,10 +170,7 @@ def merge_data(locations, cache_file=os.path.join(DATA_DIR, 'traffic_df_2024_Q4_
     # Remove rows w/o names after merging with csv files containing segment_id w/o osm.name
     if verbose:
         print('Removing rows w/o osm.name or date_local entries')
-    nan_rows = df_comb[df_comb['osm.name'].isnull()]
-    df_comb = df_comb.drop(nan_rows.index)
-    nan_rows = df_comb[df_comb['date_local'].isnull()]
-    df_comb = df_comb.drop(nan_rows.index)
+    df_comb = df_comb[df_comb['osm.name'].notna() & df_comb['date_local'].notna()]
 
     if verbose:
         print('Creating df with selected columns')
@@ -160,6 +180,7 @@ def merge_data(locations, cache_file=os.path.join(DATA_DIR, 'traffic_df_2024_Q4_
                         'car_speed0','car_speed10','car_speed20','car_speed30','car_speed40','car_speed50','car_speed60','car_speed70']
     traffic_df = pd.DataFrame(df_comb, columns=selected_columns)
     add_date_columns(traffic_df, verbose)
+    set_column_types(traffic_df)
     return traffic_df.reset_index(drop=True)
 
 
@@ -136,17 +136,21 @@ def _prepare_df(segments, df, advanced, month=None):
     # Expand speed histogram: 25 x 5km/h bins to 8 x 10km/h bins, scale back to percentages
     hist_cols = [f'car_speed{s}' for s in range(0, 80, 10)]
 
-    def expand_histogram(hist):
-        total = 0 if hist is None else sum(hist)
-        if total == 0:
-            return [0.0] * 8
-        result = [round((hist[2 * i] + hist[2 * i + 1]) * 100. / total, 2) for i in range(7)]
-        result.append(round(sum(hist[14:]) * 100. / total, 2))
-        return result
-
-    hist_df = pd.DataFrame(
-        df_out['car_speed_hist_0to120plus'].apply(expand_histogram).tolist(),
-        columns=hist_cols, index=df_out.index)
+    hists = df_out['car_speed_hist_0to120plus']
+    has_hist = hists.notna().to_numpy()
+    speed_perc = np.zeros((len(df_out), len(hist_cols)))
+    if has_hist.any():
+        # histograms are normally 25 bins long, pad shorter (or longer) ones with zeros so they stack into one array
+        rows = hists[has_hist].to_numpy()
+        lengths = np.array([len(h) for h in rows])
+        hist = np.zeros((len(rows), max(25, lengths.max())))
+        hist[np.arange(hist.shape[1]) < lengths[:, None]] = np.concatenate(rows).astype(float)
+        # pairs of 5 km/h bins up to 70 km/h, everything from 70 km/h in the last bin
+        binned = np.hstack([hist[:, :14].reshape(-1, 7, 2).sum(axis=2), hist[:, 14:].sum(axis=1, keepdims=True)])
+        total = hist.sum(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            speed_perc[has_hist] = np.where(total > 0, np.round(binned * 100. / total, 2), 0.)
+    hist_df = pd.DataFrame(speed_perc, columns=hist_cols, index=df_out.index)
     df_out = pd.concat([df_out.drop(columns=['car_speed_hist_0to120plus']), hist_df], axis=1)
 
     mode_cols = [f'{MODE_RENAME.get(m, m)}_{s}' for m in modes for s in ('lft', 'rgt', 'total')]
@@ -15,17 +15,26 @@
 
 import os
 import sys
+import json
 import gettext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 import duckdb
 import dash
-from dash import Dash, Output, Input, callback, ctx
+from dash import Dash, Output, Input, Patch, callback, ctx
 import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
 import plotly.express as px
-from threading import Lock
+import plotly.io as pio
+import plotly.graph_objects as go
+from plotly.colors import sample_colorscale
+from plotly.subplots import make_subplots
+from threading import RLock
 from dateutil import parser
 import polars as pl
 import random
@@ -45,8 +54,39 @@ from .layout import ADFC_yellow, ADFC_orange_L, ADFC_orange, ADFC_crimson, ADFC_
 DEPLOYED = __name__ != '__main__'
 ASSET_DIR = os.path.join(os.path.dirname(__file__), 'assets')
 DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'data')
-
-db_lock = Lock()
+CAR_SPEED_LABELS = {f'car_speed{speed}': f'{speed} - {speed + 10} km/h' for speed in range(0, 80, 10)}
+
+# Chart colors, shared by all callbacks
+TRAFFIC_TYPE_COLORS = {'ped_total': ADFC_lightblue, 'bike_total': ADFC_green, 'car_total': ADFC_orange, 'heavy_total': ADFC_crimson}
+BIKE_CAR_RATIO_COLORS = {
+    'More bikes than cars': ADFC_green,
+    'More cars than bikes': ADFC_blue,
+    'Over 2x more cars': ADFC_orange,
+    'Over 5x more cars': ADFC_crimson,
+    'Over 10x more cars': ADFC_pink,
+    'Inactive - no data': ADFC_lightgrey}
+# Period B of the comparison chart has the same colors as period A
+COMPARISON_COLORS = TRAFFIC_TYPE_COLORS | {col + '_d': color for col, color in TRAFFIC_TYPE_COLORS.items()}
+# Car speed colors by speed limit
+CAR_SPEED_COLORS_50 = {'car_speed0': ADFC_lightgrey, 'car_speed10': ADFC_lightblue_D,
+    'car_speed20': ADFC_lightblue, 'car_speed30': ADFC_green,
+    'car_speed40': ADFC_green_L, 'car_speed50': ADFC_orange,
+    'car_speed60': ADFC_crimson, 'car_speed70': ADFC_pink}
+CAR_SPEED_COLORS_30 = {'car_speed0': ADFC_lightgrey, 'car_speed10': ADFC_green_L,
+    'car_speed20': ADFC_green, 'car_speed30': ADFC_orange_L,
+    'car_speed40': ADFC_orange, 'car_speed50': ADFC_pink,
+    'car_speed60': ADFC_red, 'car_speed70': ADFC_crimson}
+
+# Encode the figures (for the caches and the Dash responses) with orjson, which is much faster on the trace arrays
+pio.json.config.default_engine = 'orjson'
+
+# Reentrant, so a temp table and its selected street tables can be rebuilt under one lock (see add_selected_street)
+db_lock = RLock()
+# Filter selection the temp table filtered_traffic was last created with, used as key for the comparison chart cache
+filtered_traffic_key = None
+# Selection the temp tables filtered_traffic_dt(_sel/_str) were last created with, used as key for the chart caches.
+# All sessions share these tables, so the key is only set together with the tables under db_lock.
+filtered_traffic_dt_key = None
 
 def output_excel(df, file_name):
     path = os.path.join(ASSET_DIR, file_name + '.xlsx')
@@ -78,6 +118,30 @@ def duckdb_info(con):
     mem_usage = con.execute("SELECT * FROM duckdb_memory()").fetchdf()
     print(mem_usage)
 
+def read_segment_coordinates(geojson_path):
+    # Parsing the geojson is the slowest part of the startup, so keep the coordinates as parquet until the geojson changes
+    # The cache lives in the data directory, not next to a geojson in the publicly served assets
+    cache_path = os.path.join(DATA_DIR, os.path.splitext(os.path.basename(geojson_path))[0] + '_coords.parquet')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(geojson_path):
+        return pd.read_parquet(cache_path)
+
+    # Only segment_id and the geometry are used, all other features come from df_geojson.parquet
+    geo_df = gpd.read_file(geojson_path, engine='pyogrio', columns=['segment_id'])
+    # Extract x y coordinates, index maps each coordinate back to its geometry
+    geo_df_coords, geo_df_index = shapely.get_coordinates(geo_df.geometry.values, return_index=True)
+    # Combine x y and segment_id into a new dataframe
+    geo_df_map_info = pd.DataFrame({'x': geo_df_coords[:, 0], 'y': geo_df_coords[:, 1],
+                                    'segment_id': geo_df['segment_id'].values[geo_df_index]})
+    # The cache is optional, a read-only deployment just parses the geojson on every start
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        geo_df_map_info.to_parquet(cache_path, index=False)
+    except OSError as e:
+        if not DEPLOYED:
+            print(f'Could not write coordinate cache {cache_path}: {e}')
+
+    return geo_df_map_info
+
 def retrieve_data():
     # Read geojson data file to access geometry coordinates
     if not DEPLOYED:
@@ -87,14 +151,16 @@ def retrieve_data():
     if not os.path.exists(os.path.join(data_dir, 'bzm_telraam_segments.geojson')):
         data_dir = ASSET_DIR
     geojson_path = os.path.join(data_dir, 'bzm_telraam_segments.geojson')
-    geo_cols = ['segment_id', 'osm', 'cameras', 'geometry']
-    geo_df = gpd.read_file(geojson_path, columns=geo_cols)
+    geo_file_path = os.path.join(data_dir, 'df_geojson.parquet')
 
+    # The file reads are independent of each other and of loading the traffic data into DuckDB,
+    # so run them in the background while the database gets built
+    executor = ThreadPoolExecutor(max_workers=2)
+    geo_df_future = executor.submit(read_segment_coordinates, geojson_path)
     if not DEPLOYED:
         print('Reading json data...')
-
-    geo_file_path = os.path.join(data_dir, 'df_geojson.parquet')
-    json_df_features = pd.read_parquet(geo_file_path)
+    json_df_features_future = executor.submit(pd.read_parquet, geo_file_path)
+    executor.shutdown(wait=False)
 
     # Read traffic data from file
     if not DEPLOYED:
@@ -124,11 +190,35 @@ def retrieve_data():
 
     with db_lock:
         # Alter dtypes for data processing and to enable sort order
-        conn.execute('ALTER TABLE all_traffic ALTER COLUMN day SET DATA TYPE INTEGER')
+        # day (1-31) and hour (0-23) are grouped on in several charts, TINYINT keeps their group keys small
+        conn.execute('ALTER TABLE all_traffic ALTER COLUMN day SET DATA TYPE TINYINT')
+        conn.execute('ALTER TABLE all_traffic ALTER COLUMN hour SET DATA TYPE TINYINT')
+        # Hourly counts fit exactly into FLOAT, which halves the bytes scanned while SUM/AVG still return DOUBLE
+        # (integer types would make SUM return HUGEINT), speeds stay DOUBLE since their rounded averages would change
+        for column in ['ped_total', 'bike_total', 'car_total', 'heavy_total']:
+            conn.execute(f'ALTER TABLE all_traffic ALTER COLUMN {column} SET DATA TYPE FLOAT')
+        # hardware_version is only compared against 1 and 2, files written before it was stored as Int8 hold doubles
+        conn.execute('ALTER TABLE all_traffic ALTER COLUMN hardware_version SET DATA TYPE TINYINT')
 
         # TODO: remove from parquet files
         conn.execute('ALTER TABLE all_traffic DROP COLUMN last_data_package')
 
+        # Store repetitive string columns as (dictionary encoded) ENUM to speed up filtering and grouping
+        for column in ['id_street', 'year', 'month', 'Monat', 'year_month', 'jahr_monat', 'year_week', 'weekday', 'Wochentag', 'date', 'date_hour']:
+            conn.execute(f'CREATE TYPE {column}_enum AS ENUM '
+                         f'(SELECT DISTINCT {column} FROM all_traffic WHERE {column} IS NOT NULL ORDER BY {column})')
+            conn.execute(f'ALTER TABLE all_traffic ALTER COLUMN {column} SET DATA TYPE {column}_enum')
+
+        # street_selection also gets the street names (see add_selected_street), so charts group on ENUM codes only
+        conn.execute("CREATE TYPE street_selection_enum AS ENUM ("
+                     "SELECT street_selection FROM all_traffic WHERE street_selection IS NOT NULL "
+                     "UNION SELECT split_part(id_street, ' (', 1) FROM all_traffic WHERE id_street IS NOT NULL "
+                     "ORDER BY 1)")
+        conn.execute('ALTER TABLE all_traffic ALTER COLUMN street_selection SET DATA TYPE street_selection_enum')
+
+    geo_df_map_info = geo_df_future.result()
+    json_df_features = json_df_features_future.result()
+
     # Prepare bike/care ratios
     query = f"""
     SELECT 
@@ -177,6 +267,8 @@ def retrieve_data():
     # with db_lock:
     #     conn.execute(query)
 
+    # Store all_traffic sorted by date once, so the row group min/max statistics let the date range filters
+    # skip most of the table
     query = """
     CREATE OR REPLACE TABLE all_traffic AS
     SELECT a.*,
@@ -184,6 +276,7 @@ def retrieve_data():
         j.street_type AS street_type
     FROM all_traffic AS a
     LEFT JOIN last_data_package_table AS j ON a.segment_id = j.segment_id
+    ORDER BY a.date_local, a.segment_id
     """
 
     with db_lock:
@@ -193,86 +286,133 @@ def retrieve_data():
     # Free memory
     del last_data_package_df
 
-    return geo_df, json_df_features, traffic_df_id_bc, conn
+    return geo_df_map_info, json_df_features, traffic_df_id_bc, conn
+
+@lru_cache(maxsize=None)
+def get_translations(lang_code):
+    # Look up and load the catalog only once per language, switching languages just installs it again
+    appname = 'bzm'
+    localedir = os.path.join(os.path.dirname(__file__), 'locales')
+    return gettext.translation(appname, localedir, fallback=True, languages=[lang_code])
 
 def update_language(lang_code):
     global language
     language=lang_code
 
-    # Initiate translation
-    appname = 'bzm'
-    localedir = os.path.join(os.path.dirname(__file__), 'locales')
-    # Set up Gettext
-    translations = gettext.translation(appname, localedir, fallback=True, languages=[language])
     # Install translation function
-    translations.install()
+    get_translations(language).install()
 
-def convert(date_time, format_string):
-    datetime_obj = datetime.strptime(date_time, format_string)
-    return datetime_obj
+    # Translate the labels shared by all charts once per language instead of in every callback
+    global traffic_type_labels, all_streets_label, segment_label, traffic_type_title, time_division_labels, time_unit_labels
+    traffic_type_labels = {'ped_total': _('Pedestrians'), 'bike_total': _('Bikes'), 'car_total': _('Cars'), 'heavy_total': _('Heavy')}
+    all_streets_label = _('All Streets')
+    segment_label = _(' (segment:')
+    traffic_type_title = _('Traffic Type')
+    time_division_labels = {'year': _('Year'), 'year_month': _('Month'), 'year_week': _('Week'), 'date': _('Day'), 'date_hour': _('Hour')}
+    time_unit_labels = {'year': _('Year'), 'month': _('Month'), 'weekday': _('Week'), 'day': _('Day'), 'hour': _('Hour')}
 
 def format_str_date(str_date, from_date_format, to_date_format):
     timestamp_date = datetime.strptime(str_date, from_date_format)
     formatted_str_date = timestamp_date.strftime(to_date_format)
     return formatted_str_date
 
+def get_day_range(start_date, end_date):
+    # Return the timestamps [start, end) covering all complete days from start_date to end_date,
+    # this is equivalent to comparing the day of date_local but does not need to parse each row
+    start_ts = parser.parse(start_date)
+    start_day = datetime.combine(start_ts.date(), datetime.min.time())
+    if start_ts > start_day:
+        start_day += timedelta(days=1)
+    end_day = datetime.combine(parser.parse(end_date).date(), datetime.min.time()) + timedelta(days=1)
+    return start_day, end_day
+
 def add_selected_street(from_table_name, id_street, street_name):
 
-    # Add or update table with selected street
-    query = (f'CREATE OR REPLACE TEMP TABLE selected_street AS '
-             f'SELECT * FROM {from_table_name} '
+    # Add or update table with the rows of the selected street, labelled with the street name
+    selected_table_name = from_table_name + '_sel'
+    query = (f'CREATE OR REPLACE TEMP TABLE {selected_table_name} AS '
+             f'SELECT * REPLACE (CAST(? AS street_selection_enum) AS street_selection) '
+             f'FROM {from_table_name} '
              f'WHERE id_street = ?')
-    params = [id_street]
-    conn.execute(query, params)
-
-    # Replace "All streets" with selected street name
-    query = ('UPDATE selected_street '
-             'SET street_selection = ?')
-    params = [street_name]
-    conn.execute(query, params)
+    params = [street_name, id_street]
 
-    # Add selected street to filtered_traffic_dt
+    # Combine "All streets" and the selected street in a view, this avoids copying all rows
     to_table_name = from_table_name + '_str'
-    query = (f'CREATE OR REPLACE TEMP TABLE {to_table_name} AS '
-             f'SELECT * FROM {from_table_name} '
-             f'UNION ALL '
-             f'SELECT * FROM selected_street')
-    conn.execute(query)
+    query_view = (f'CREATE OR REPLACE TEMP VIEW {to_table_name} AS '
+                  f'SELECT * FROM {from_table_name} '
+                  f'UNION ALL '
+                  f'SELECT * FROM {selected_table_name}')
 
-    # Delete (drop) the street_selection table
-    conn.execute('DROP TABLE IF EXISTS selected_street')
+    with db_lock:
+        conn.execute(query, params)
+        conn.execute(query_view)
 
     return
 
+@lru_cache(maxsize=256)
+def fetch_aggregate(query, params, data_key):
+    # data_key identifies the selection filtered_traffic_dt(_str) was built from, so that
+    # aggregates can be reused when only the chart type, time unit or language changes
+    with db_lock:
+        # Another session may have rebuilt the tables in the meantime, never cache its data under this key
+        if data_key != filtered_traffic_dt_key:
+            raise PreventUpdate
+        return conn.execute(query, list(params)).pl()
+
+def facet_title(text, street_name, street_title):
+    # Facet annotations read 'street_selection=<street>', show the street with its segment or the translated label
+    return text.split('=')[1].replace(street_name, street_title).replace('All Streets', all_streets_label)
+
 def get_bike_car_ratios(traffic_df_id_bc):
 
     bins = [0, 0.1, 0.2, 0.5, 1, 500]
     speed_labels = ['Over 10x more cars', 'Over 5x more cars', 'Over 2x more cars', 'More cars than bikes', 'More bikes than cars']
-    traffic_df_id_bc['map_line_color'] = pd.cut(traffic_df_id_bc['bike_car_ratio'], bins=bins, labels=speed_labels)
+    # Bucketize like pd.cut with right closed bins, ratios outside (0, 500] and NaN get code -1 i.e. no category
+    codes = np.digitize(traffic_df_id_bc['bike_car_ratio'].to_numpy(), bins=bins, right=True) - 1
+    codes[(codes < 0) | (codes >= len(speed_labels))] = -1
+    traffic_df_id_bc['map_line_color'] = pd.Categorical.from_codes(codes, categories=speed_labels, ordered=True)
 
     # Prepare traffic_df_id_bc for join operation
     traffic_df_id_bc.set_index('segment_id', inplace=True)
 
     return traffic_df_id_bc
 
-def update_map_data(df_map_base, df, active_selected, hardware_version, street_type_dd):
+def prepare_map_data(df_map_base, df):
 
     # Prepare map info by joining geo_df_map_info with map_line_color from traffic_df_id_bc (based on bike/car ratios)
     df_map = df_map_base.join(df)
     # Remove rows w/o segment_id
-    nan_rows = df_map[df_map['segment_id'].isnull()]
-    df_map = df_map.drop(nan_rows.index)
+    df_map = df_map[df_map['segment_id'].notna()]
 
     # TODO: some streets in "bzm_telraam_segments.geojson" have no camera info and so appear as hardware version "0", the below puts these to "1"
     df_map['hardware_version'] = df_map['hardware_version'].replace(0,1)
 
+    # Add map_line_color category and add column information to cover inactive cameras
+    df_map['map_line_color'] = df_map['map_line_color'].cat.add_categories([('Inactive - no data')])
+    df_map.fillna({'map_line_color': ('Inactive - no data')}, inplace=True)
+    # Sort data to get desired legend order, the filters in update_map_data keep this order
+    df_map = df_map.sort_values(by=['map_line_color'], kind='stable')
+
+    # Move segment_id index to column (avoid ambiguity by two segment_id columns in line_map Plotly v6.0)
+    df_map = df_map.drop('segment_id', axis=1)
+    df_map.reset_index(level=0, inplace=True)
+    df_map['segment_id']=df_map['segment_id'].astype(str)
+
+    # Free memory
+    del df, df_map_base
+
+    return df_map
+
+def update_map_data(df_map_all, active_selected, hardware_version, street_type_dd):
+
+    # The bike/car ratios are joined once in prepare_map_data, the filters only select rows
+    df_map = df_map_all
+
     # TODO: Filter uptime although at the moment it looks like there are no streets with < 0.7 uptime only
     # Filter on active cameras (data available later than two weeks ago)
     if active_selected == ['filter_active_selected']:
-        # get segment_id's with data >= two weeks ago
-        df_map_active = df_map[df_map['last_data_package'] >= two_weeks_ago]
-        active_segment_ids = df_map_active['segment_id'].unique()
-        df_map = df_map[df_map['segment_id'].isin(active_segment_ids)]
+        # last_data_package is the same on all rows of a segment, so the mask keeps whole segments
+        df_map = df_map[df_map['last_data_package'] >= two_weeks_ago]
 
     # Filter on camera hardware version
     if hardware_version == [1]:
@@ -284,47 +424,84 @@ def update_map_data(df_map_base, df, active_selected, hardware_version, street_t
     if street_type_dd in ['primary', 'secondary', 'tertiary', 'residential']:
         df_map = df_map[df_map['osm.highway'] == street_type_dd]
 
-    # Add map_line_color category and add column information to cover inactive cameras
-    df_map['map_line_color'] = df_map['map_line_color'].cat.add_categories([('Inactive - no data')])
-    df_map.fillna({'map_line_color': ('Inactive - no data')}, inplace=True)
-    # Sort data to get desired legend order
-    df_map = df_map.sort_values(by=['map_line_color'])
+    return df_map
 
-    # Move segment_id index to column (avoid ambiguity by two segment_id columns in line_map Plotly v6.0)
-    df_map = df_map.drop('segment_id', axis=1)
-    df_map.reset_index(level=0, inplace=True)
-    df_map['segment_id']=df_map['segment_id'].astype(str)
+@lru_cache(maxsize=16)
+def get_map_data(active_selected, hardware_version, street_type_dd):
+    # df_map_all does not change after loading, so the map data only depends on the filters,
+    # the returned data frame is shared and must not be modified
+    return update_map_data(df_map_all, list(active_selected), list(hardware_version), street_type_dd)
 
-    # Free memory
-    del df, df_map_base
+@lru_cache(maxsize=16)
+def get_map_street_options(active_selected, hardware_version, street_type_dd):
+    df_map = get_map_data(active_selected, hardware_version, street_type_dd)
 
-    return df_map
+    # Options for street_name_dd, without inactive
+    df_map_options = df_map[df_map['map_line_color']!='Inactive - no data']
+    street_name_dd_options = sorted(df_map_options['id_street'].unique())
 
-def get_min_max_str(start_date, end_date, id_street, table):
-    missing_data = False
-    message = 'none'
+    return df_map['segment_id'].nunique(), street_name_dd_options
 
-    query = f"""
-    SELECT min(date_local)
-    FROM {table}
-    WHERE id_street = ?
-    """
-    params = [id_street]
+@lru_cache(maxsize=32)
+def create_street_map(toggle_active_filter, hardware_version, street_type_dd, map_style, lang_code):
+    # The map only changes with the filters, style and language, center and zoom are set per callback
+    df_map = get_map_data(toggle_active_filter, hardware_version, street_type_dd)
 
-    with db_lock:
-        min_date_local = conn.execute(query, params).fetchone()
-    min_date = min_date_local[0].strftime('%Y-%m-%dT%H:%M:%S')
+    sep = '&nbsp;|&nbsp;'
+
+    street_map = px.line_map(df_map, lat='y', lon='x', custom_data=['segment_id', 'hardware_version'],line_group='segment_id', hover_name = 'osm.name', color= 'map_line_color',
+        color_discrete_map=BIKE_CAR_RATIO_COLORS,
+        hover_data={'map_line_color': False, 'osm.highway': True, 'osm.address.city': True, 'osm.address.suburb': True, 'osm.address.postcode': True, 'hardware_version': True, 'osm.maxspeed': True},
+        labels={'segment_id': 'Segment', 'osm.highway': _('Highway type'), 'x': 'Lon', 'y': 'Lat', 'osm.address.city': _('City'), 'osm.address.suburb': _('District'), 'osm.address.postcode': _('Postal code'), 'hardware_version': _('Hardware version'), 'osm.maxspeed': _('Speed limit')},
+        map_style=map_style)
 
+    street_map.update_traces(mode='lines+markers')
+    street_map.update_traces(line_width=5, opacity=0.7)
+    # Translate the trace names in one pass, the names are the message ids of the bike/car ratio categories
+    street_map.for_each_trace(lambda t: t.update(name=_(t.name), visible='legendonly' if t.name == 'Inactive - no data' else None))
+    street_map.update_layout(uirevision=True, autosize=False, margin=dict(l=0, r=0, t=0, b=0), legend_title=_('Street color'),
+                             legend=dict(bgcolor='rgba(255,255,255,0.6)', yanchor="top", y=0.99, xanchor="right", x=0.99), annotations=[
+        dict(
+            text=(
+                sep.join([
+                    '<a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a>',
+                    '<a href="https://telraam.net">Telraam</a>',
+                    '<a href="https://www.berlin.de/sen/uvk/mobilitaet-und-verkehr/verkehrsplanung/radverkehr/weitere-radinfrastruktur/zaehlstellen-und-fahrradbarometer/">SenUMVK Berlin<br></a>'
+                ]) + '' +
+                sep.join([
+                    '<a href="https://berlin-zaehlt.de/csv/">CSV</a> and <a href="https://berlin-zaehlt.de/parquet/">Parquet</a> data under <a href="https://creativecommons.org/licenses/by/4.0/">CC-BY 4.0</a> and <a href="https://www.govdata.de/dl-de/by-2-0">dl-de/by-2-0</a>'
+                ])
+            ),
+            showarrow=False, align='left', xref='paper', yref='paper', x=0, y=0
+        )
+    ])
+
+    # Cache the figure in its JSON form, so Dash does not need to encode the arrays again on every response
+    return json.loads(street_map.to_json())
+
+@lru_cache(maxsize=8)
+def get_street_date_ranges(table, filter_key):
+    # First and last date of every street in one pass, filter_key identifies the content of table (see update_graphs)
     query = f"""
-    SELECT max(date_local)
+    SELECT id_street, min(date_local), max(date_local)
     FROM {table}
-    WHERE id_street = ?
+    GROUP BY id_street
     """
-    params = [id_street]
 
     with db_lock:
-        max_date_local = conn.execute(query, params).fetchone()
-    max_date = max_date_local[0].strftime('%Y-%m-%dT%H:%M:%S')
+        # Another session may have rebuilt filtered_traffic in the meantime, never cache its data under this key
+        if table == 'filtered_traffic' and filter_key != filtered_traffic_key:
+            raise PreventUpdate
+        date_ranges = conn.execute(query).fetchall()
+
+    return {id_street: (min_date_local.strftime('%Y-%m-%dT%H:%M:%S'), max_date_local.strftime('%Y-%m-%dT%H:%M:%S'))
+            for id_street, min_date_local, max_date_local in date_ranges}
+
+def get_min_max_str(start_date, end_date, id_street, table, filter_key=None):
+    missing_data = False
+    message = 'none'
+
+    min_date, max_date = get_street_date_ranges(table, filter_key)[id_street]
 
     if start_date > max_date or end_date < min_date:
         missing_data = True
@@ -378,7 +555,7 @@ street_name, segment_id = INITIAL_STREET_ID[:-1].split(" (")
 
 #zoom_factor =8
 
-geo_df, json_df_features, traffic_df_id_bc, conn = retrieve_data()
+geo_df_map_info, json_df_features, traffic_df_id_bc, conn = retrieve_data()
 
 update_language(INITIAL_LANGUAGE)
 
@@ -389,8 +566,8 @@ update_language(INITIAL_LANGUAGE)
 # Get min max dates from complete data set
 query = """
 SELECT 
-    MIN(STRPTIME(date, '%d-%m-%Y')) AS start_date,
-    MAX(STRPTIME(date, '%d-%m-%Y')) AS end_date
+    DATE_TRUNC('day', MIN(date_local)) AS start_date,
+    DATE_TRUNC('day', MAX(date_local)) AS end_date
 FROM all_traffic
 """
 
@@ -419,8 +596,7 @@ end_date = datetime.strftime(end_date, to_date_format)
 min_date, max_date, start_date, end_date, message, missing_data = get_min_max_str(start_date, end_date, INITIAL_STREET_ID, 'all_traffic')
 
 # Get active filter date (two weeks ago from the last date in the dataset)
-from_date_format = '%Y-%m-%dT%H:%M:%S'
-end_date_dt = convert(end_date, from_date_format)
+end_date_dt = pd.Timestamp(end_date)
 two_weeks_ago_dt = end_date_dt - timedelta(weeks=2)
 two_weeks_ago = two_weeks_ago_dt.strftime('%Y-%m-%dT%H:%M:%S')
 
@@ -450,16 +626,6 @@ if not DEPLOYED:
 if not DEPLOYED:
     print('Add bike/car ratio column...')
 
-# Extract x y coordinates from geo_df (geopandas file)
-geo_df_coords = geo_df.get_coordinates()
-# Get ids to join with x y coordinates
-geo_df_ids = geo_df[['segment_id']]
-# Join x y and segment_id into e new dataframe
-geo_df_map_info = geo_df_coords.join(geo_df_ids)
-
-# Free memory
-del geo_df_coords, geo_df_ids
-
 # Prepare geo_df_map_info and json_df_features and join
 geo_df_map_info['segment_id'] = geo_df_map_info['segment_id'].astype(int)
 geo_df_map_info.set_index('segment_id', drop= False, inplace=True)
@@ -468,8 +634,7 @@ json_df_features.set_index('segment_id', inplace=True)
 #TODO: move json_df_features to geopandas
 df_map_base = geo_df_map_info.join(json_df_features)
 # Remove rows w/o street names
-nan_rows = df_map_base[df_map_base['osm.name'].isnull()]
-df_map_base = df_map_base.drop(nan_rows.index)
+df_map_base = df_map_base[df_map_base['osm.name'].notna()]
 
 # Free memory
 del json_df_features
@@ -478,7 +643,11 @@ del json_df_features
 traffic_df_id_bc = get_bike_car_ratios(traffic_df_id_bc)
 
 # Join map data and bike/car ratio data to df_map
-df_map = update_map_data(df_map_base, traffic_df_id_bc, 'toggle_active_filter', [1,2], 'all')
+df_map_all = prepare_map_data(df_map_base, traffic_df_id_bc)
+df_map = update_map_data(df_map_all, 'toggle_active_filter', [1,2], 'all')
+
+# Lookup of the per segment info needed by the callbacks, avoids scanning df_map on every selection
+segment_info = df_map.drop_duplicates('segment_id').set_index('segment_id')[['x', 'y', 'hardware_version', 'osm.highway', 'osm.maxspeed', 'map_line_color']].to_dict('index')
 
 ### Run Dash app ###
 if not DEPLOYED:
@@ -555,18 +724,18 @@ def update_map(clickData, id_street, street_type_dd, hardware_version, toggle_ac
         map_style = toggle_map_style
 
     # Get hardware version and street type of currently selected street
-    current_hw = int(df_map_base.loc[df_map_base['id_street'] == id_street, 'hardware_version'].iloc[0])
-    current_street_type = df_map_base.loc[df_map_base['id_street'] == id_street, 'osm.highway'].iloc[0]
+    current_segment = segment_info[id_street[-11:-1]]
+    current_hw = int(current_segment['hardware_version'])
+    current_street_type = current_segment['osm.highway']
 
-    # Update df-map data in case of active filter change, hardware change or street_type change
-    if callback_trigger == 'toggle_active_filter' or 'hardware_version' or 'street_type_dd':
-        df_map = update_map_data(df_map_base, traffic_df_id_bc, toggle_active_filter, hardware_version, street_type_dd)
+    # Get df-map data for the active filter, hardware version and street_type, only rebuilt when these change
+    df_map = get_map_data(tuple(toggle_active_filter), tuple(hardware_version), street_type_dd)
 
     preferred_streets = ['Dresdener Straße (9000006667)', 'Platz der Luftbrücke (9000007879)','Wilhelmstraße (9000008514)', 'Leipziger Straße (9000008543)', 'Köpenicker Straße (9000006435)', 'Adalbertstraße (9000009042)','Alte Jakobstraße (9000002582)']
-    # Create a colum that marks preferred streets
-    df_map['preferred_street'] = df_map['id_street'].isin(preferred_streets)
+    # Mark preferred streets (df_map is cached, so not as a column)
+    preferred_street = df_map['id_street'].isin(preferred_streets)
     # CHeck if df_map contains any preferred streets
-    nof_preferred_streets = df_map['preferred_street'].sum()
+    nof_preferred_streets = preferred_street.sum()
     preferred_street_available = False
     if nof_preferred_streets > 0:
         preferred_street_available = True
@@ -575,20 +744,20 @@ def update_map(clickData, id_street, street_type_dd, hardware_version, toggle_ac
         if toggle_active_filter == ['filter_active_selected']:
             if preferred_street_available:
                 # Switch to first preferred street
-                id_street = df_map.loc[df_map['preferred_street'] == True, 'id_street'].iloc[0]
+                id_street = df_map['id_street'].iat[preferred_street.argmax()]
             else:
                 # Set to random available street
-                id_street = df_map['id_street'][random.randint(0,len(df_map))]
+                id_street = df_map['id_street'].iat[random.randrange(len(df_map))]
 
     # Set new street if current street does not fit the hardware version
     if callback_trigger == 'hardware_version':
         if hardware_version == [1] and current_hw == 2 or hardware_version == [2] and current_hw == 1:
             if preferred_street_available:
                 # Switch to first preferred street
-                id_street = df_map.loc[df_map['preferred_street'] == True, 'id_street'].iloc[0]
+                id_street = df_map['id_street'].iat[preferred_street.argmax()]
             else:
                 # Set to random available street
-                id_street = df_map['id_street'][random.randint(0,len(df_map))]
+                id_street = df_map['id_street'].iat[random.randrange(len(df_map))]
         elif hardware_version == []:
             # Do not allow to switch off both hardware versions
             hardware_version = [1, 2]
@@ -598,28 +767,21 @@ def update_map(clickData, id_street, street_type_dd, hardware_version, toggle_ac
         if street_type_dd != current_street_type:
             if preferred_street_available:
                 # Switch to first preferred street
-                id_street = df_map.loc[df_map['preferred_street'] == True, 'id_street'].iloc[0]
+                id_street = df_map['id_street'].iat[preferred_street.argmax()]
             else:
                 # Set to random available street
-                id_street = df_map['id_street'][random.randint(0,len(df_map))]
-
-    # Get number of selected segments
-    nof_selected_segments = _('Number of selected segments: ') + str(len(df_map['segment_id'].unique()))
-
-    # Update options for street_name_dd, without inactive
-    df_map_options = df_map[df_map['map_line_color']!='Inactive - no data']
-    street_name_dd_options = sorted(df_map_options['id_street'].unique())
+                id_street = df_map['id_street'].iat[random.randrange(len(df_map))]
 
-    # Free up memory
-    del df_map_options
+    # Get number of selected segments and options for street_name_dd, only recomputed when the filters change
+    nof_segments, street_name_dd_options = get_map_street_options(tuple(toggle_active_filter), tuple(hardware_version), street_type_dd)
+    nof_selected_segments = _('Number of selected segments: ') + str(nof_segments)
 
     # Update map in case of selected street change
     if callback_trigger == 'street_map':
         street_name = clickData['points'][0]['hovertext']
         segment_id = clickData['points'][0]['customdata'][0]
-        idx = df_map.loc[df_map['segment_id'] == segment_id]
         # Check if street inactive, if so, prevent update
-        map_color_status = idx['map_line_color'].values[0]
+        map_color_status = segment_info[segment_id]['map_line_color']
         if map_color_status == 'Inactive - no data':
             raise PreventUpdate
         else:
@@ -627,16 +789,13 @@ def update_map(clickData, id_street, street_type_dd, hardware_version, toggle_ac
             id_street = street_name + ' (' + segment_id + ')'
     elif callback_trigger == 'street_name_dd':
         segment_id = id_street[-11:-1]
-        idx = df_map.loc[df_map['segment_id'] == segment_id]
         zoom_factor = 13
     elif callback_trigger == 'hardware_version' or 'street_type_dd':
         segment_id = id_street[-11:-1]
-        idx = df_map.loc[df_map['segment_id'] == segment_id]
         zoom_factor = 11
     else:
         # Zoom out upon initial load or hardware change
         segment_id = id_street[-11:-1]
-        idx = df_map.loc[df_map['segment_id'] == segment_id]
         zoom_factor = 10
 
     # Get maximum speed for the selected street
@@ -644,328 +803,132 @@ def update_map(clickData, id_street, street_type_dd, hardware_version, toggle_ac
 
 
     # TODO: improve efficiency by managing translation w/o recalculating bc ratios
-    lon_str = idx['x'].values[0]
-    lat_str = idx['y'].values[0]
-
-    sep = '&nbsp;|&nbsp;'
-
-    street_map = px.line_map(df_map, lat='y', lon='x', custom_data=['segment_id', 'hardware_version'],line_group='segment_id', hover_name = 'osm.name', color= 'map_line_color',
-        color_discrete_map= {
-        'More bikes than cars': ADFC_green,
-        'More cars than bikes': ADFC_blue,
-        'Over 2x more cars': ADFC_orange,
-        'Over 5x more cars': ADFC_crimson,
-        'Over 10x more cars': ADFC_pink,
-        'Inactive - no data': ADFC_lightgrey},
-        hover_data={'map_line_color': False, 'osm.highway': True, 'osm.address.city': True, 'osm.address.suburb': True, 'osm.address.postcode': True, 'hardware_version': True, 'osm.maxspeed': True},
-        labels={'segment_id': 'Segment', 'osm.highway': _('Highway type'), 'x': 'Lon', 'y': 'Lat', 'osm.address.city': _('City'), 'osm.address.suburb': _('District'), 'osm.address.postcode': _('Postal code'), 'hardware_version': _('Hardware version'), 'osm.maxspeed': _('Speed limit')},
-        map_style=map_style, center= dict(lat=lat_str, lon=lon_str), zoom= zoom_factor)
-
-    street_map.update_traces(mode='lines+markers')
-    street_map.update_traces(line_width=5, opacity=0.7)
-    street_map.update_traces({'name': _('More bikes than cars')}, selector={'name': 'More bikes than cars'})
-    street_map.update_traces({'name': _('More cars than bikes')}, selector={'name': 'More cars than bikes'})
-    street_map.update_traces({'name': _('Over 2x more cars')}, selector={'name': 'Over 2x more cars'})
-    street_map.update_traces({'name': _('Over 5x more cars')}, selector={'name': 'Over 5x more cars'})
-    street_map.update_traces({'name': _('Over 10x more cars')}, selector={'name': 'Over 10x more cars'})
-    street_map.update_traces({'name': _('Inactive - no data')}, selector={'name': 'Inactive - no data'}, visible='legendonly')
-    street_map.update_layout(uirevision=True)
-    street_map.update_layout(autosize=False)
-    street_map.update_layout(margin=dict(l=0, r=0, t=0, b=0))
-    street_map.update_layout(legend_title=_('Street color'))
-    street_map.update_layout(legend=dict(bgcolor='rgba(255,255,255,0.6)', yanchor="top", y=0.99, xanchor="right", x=0.99))
-    street_map.update_layout(annotations=[
-        dict(
-            text=(
-                sep.join([
-                    '<a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a>',
-                    '<a href="https://telraam.net">Telraam</a>',
-                    '<a href="https://www.berlin.de/sen/uvk/mobilitaet-und-verkehr/verkehrsplanung/radverkehr/weitere-radinfrastruktur/zaehlstellen-und-fahrradbarometer/">SenUMVK Berlin<br></a>'
-                ]) + '' +
-                sep.join([
-                    '<a href="https://berlin-zaehlt.de/csv/">CSV</a> and <a href="https://berlin-zaehlt.de/parquet/">Parquet</a> data under <a href="https://creativecommons.org/licenses/by/4.0/">CC-BY 4.0</a> and <a href="https://www.govdata.de/dl-de/by-2-0">dl-de/by-2-0</a>'
-                ])
-            ),
-            showarrow=False, align='left', xref='paper', yref='paper', x=0, y=0
-        )
-    ])
+    lon_str = segment_info[segment_id]['x']
+    lat_str = segment_info[segment_id]['y']
+
+    if callback_trigger in ['street_map', 'street_name_dd']:
+        # Filters are unchanged on a street selection, so only send the new center and zoom to the browser
+        street_map = Patch()
+        street_map['layout']['map']['center'] = dict(lat=float(lat_str), lon=float(lon_str))
+        street_map['layout']['map']['zoom'] = zoom_factor
+    else:
+        # Only center and zoom depend on the selected street, so copy just the layout parts which change
+        street_map = create_street_map(tuple(toggle_active_filter), tuple(hardware_version), street_type_dd, map_style, language)
+        map_layout = dict(street_map['layout']['map'], center=dict(lat=float(lat_str), lon=float(lon_str)), zoom=zoom_factor)
+        street_map = dict(street_map, layout=dict(street_map['layout'], map=map_layout))
 
     return street_map, hardware_version, street_name_dd_options, id_street, nof_selected_segments, toggle_map_style
 
-### General traffic callback ###
-@callback(
-    Output(component_id='selected_street_header', component_property='children'),
-    Output(component_id='selected_street_header', component_property='style'),
-    Output(component_id='street_id_text', component_property='children'),
-    Output(component_id='date_range_text', component_property='children'),
-    Output(component_id="date_filter", component_property="start_date", allow_duplicate=True),
-    Output(component_id="date_filter", component_property="end_date", allow_duplicate=True),
-    Output(component_id="date_filter", component_property="min_date_allowed"),
-    Output(component_id="date_filter", component_property="max_date_allowed"),
-    Output(component_id='date_range_text', component_property='style'),
-    Output(component_id='pie_traffic', component_property='figure'),
-    Output(component_id='line_abs_traffic', component_property='figure'),
-    Output(component_id='bar_avg_traffic_hr', component_property='figure'),
-    Output(component_id='bar_avg_traffic', component_property='figure'),
-    Output(component_id='bar_perc_speed', component_property='figure'),
-    Output(component_id='bar_v85', component_property='figure'),
-    Output(component_id='bar_ranking', component_property='figure'),
-    Input(component_id='radio_time_division', component_property='value'),
-    Input(component_id='radio_time_unit', component_property='value'),
-    Input(component_id='street_name_dd', component_property='value'),
-    Input(component_id='street_type_dd', component_property='value'),
-    Input(component_id="date_filter", component_property="start_date"),
-    Input(component_id="date_filter", component_property="end_date"),
-    Input(component_id='range_slider', component_property='value'),
-    Input(component_id='toggle_uptime_filter', component_property='value'),
-    Input(component_id='toggle_active_filter', component_property='value'),
-    Input(component_id='hardware_version', component_property='value'),
-    Input(component_id='radio_y_axis', component_property='value'),
-    Input(component_id='language_selector', component_property='value'),
-    Input(component_id='toggle_map_style', component_property='value'),
-    prevent_initial_call='initial_duplicate',
-)
-
-def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_dd, start_date, end_date, hour_range, toggle_uptime_filter, toggle_active_filter, hardware_version, radio_y_axis, lang_code_dd, toggle_map_style):
-
-    callback_trigger = ctx.triggered_id
-
-    # Avoid chart refresh when map refresh only is needed
-    if callback_trigger == 'toggle_map_style':
-        return dash.no_update
-
-    # Get segment_id/street name
+@lru_cache(maxsize=16)
+def create_graphs(data_key, id_street, start_date_str, end_date_str, hour_range, radio_time_division, radio_time_unit, radio_y_axis, lang_code):
+    # Figures only depend on the selection (data_key), the chart settings and the language, so revisiting a
+    # selection skips building them. data_key is the state of the filtered tables (filtered_traffic_dt_key), not
+    # the callback arguments. If the tables change while building, fetch_aggregate raises and nothing is cached.
     segment_id = id_street[-11:-1]
-    street_id_text = _('Selected segment ID: ') + str(segment_id)
     street_name = id_street.split(' (')[0]
-    selected_street_header = street_name
-
-    #TODO: First callback triggers "hardware version"?
-    ### Filter all traffic
-    if callback_trigger in ['toggle_uptime_filter', 'toggle_active_filter', 'hardware_version', 'street_type_dd']:
+    # Facet title of the selected street
+    street_title = street_name + segment_label + segment_id + ')'
+    # Date and hour range, shown in all chart titles
+    title_suffix = f' ({start_date_str} - {end_date_str}, {hour_range[0]} - {hour_range[1]} h)'
 
-        query = ('CREATE OR REPLACE TEMP TABLE filtered_traffic AS '
-                 'SELECT * '
-                 'FROM all_traffic ')
-        params = []
+    # Create pie chart, from the selected street rows only instead of filtering the combined view
+    query = ('SELECT street_selection, '
+             'SUM(ped_total) AS ped_total, '
+             'SUM(bike_total) AS bike_total, '
+             'SUM(car_total) AS car_total, '
+             'SUM(heavy_total) AS heavy_total '
+             'FROM filtered_traffic_dt_sel '
+             'GROUP BY street_selection')
+    params = ()
 
-        # Filter all_traffic
-        if toggle_uptime_filter == ['filter_uptime_selected']:
-            # Filter uptime
-            query += 'WHERE uptime > 0.7 '
-            if toggle_active_filter == ['filter_active_selected']:
-                # Filter active cameras
-                query += 'AND CAST(last_data_package_naive AS DATE) >= ? '
-                params = [two_weeks_ago]
-            if hardware_version == [1]:
-                query += 'AND hardware_version = 1 '
-            elif hardware_version == [2]:
-                query += 'AND hardware_version = 2 '
-            if street_type_dd == 'primary':
-                query += 'AND street_type = ? '
-                params.append('primary')
-            elif street_type_dd == 'secondary':
-                query += 'AND street_type = ? '
-                params.append('secondary')
-            elif street_type_dd == 'tertiary':
-                query += 'AND street_type = ? '
-                params.append('tertiary')
-            elif street_type_dd == 'residential':
-                query += 'AND street_type = ? '
-                params.append('residential')
-        else:
-            # Filter active selected
-            if toggle_active_filter == ['filter_active_selected']:
-                query += 'WHERE CAST(last_data_package_naive AS DATE) >= ? '
-                params = [two_weeks_ago]
-                if hardware_version == [1]:
-                    query += 'AND hardware_version = 1 '
-                elif hardware_version == [2]:
-                    query += 'AND hardware_version = 2 '
-                if street_type_dd == 'primary':
-                    query += 'AND street_type = ? '
-                    params.append('primary')
-                elif street_type_dd == 'secondary':
-                    query += 'AND street_type = ? '
-                    params.append('secondary')
-                elif street_type_dd == 'tertiary':
-                    query += 'AND street_type = ? '
-                    params.append('tertiary')
-                elif street_type_dd == 'residential':
-                    query += 'AND street_type = ? '
-                    params.append('residential')
-            else:
-                if hardware_version == [1]:
-                    query += 'WHERE hardware_version = 1 '
-                elif hardware_version == [2]:
-                    query += 'WHERE hardware_version = 2 '
-                if street_type_dd == 'primary':
-                    query += 'AND street_type = ? '
-                    params.append('primary')
-                elif street_type_dd == 'secondary':
-                    query += 'AND street_type = ? '
-                    params.append('secondary')
-                elif street_type_dd == 'tertiary':
-                    query += 'AND street_type = ? '
-                    params.append('tertiary')
-                elif street_type_dd == 'residential':
-                    query += 'AND street_type = ? '
-                    params.append('residential')
+    df_pie = fetch_aggregate(query, params, data_key)
 
-        # Add or update table filtered_traffic
-        with db_lock:  # Ensure thread safety for writes
-            conn.execute(query, params)
-            # Remove unnecessary columns
-            conn.execute('CREATE OR REPLACE TEMP TABLE filtered_traffic AS SELECT * EXCLUDE (uptime, hardware_version, last_data_package_naive) FROM filtered_traffic')
+    # The four slices are built from plain lists, a data frame for four values is not worth it
+    pie_cols = ['ped_total', 'bike_total', 'car_total', 'heavy_total']
+    pie_traffic = go.Figure(go.Pie(labels=[traffic_type_labels[col] for col in pie_cols], values=df_pie.select(pl.col(pie_cols).sum()).row(0),
+                                   marker_colors=[TRAFFIC_TYPE_COLORS[col] for col in pie_cols],
+                                   textposition='inside', textinfo='percent+label'))
 
-    # Check if selected street has data for selected data range
-    min_date, max_date, start_date, end_date, message, missing_data = get_min_max_str(start_date, end_date, id_street, 'filtered_traffic')
+    pie_traffic.update_layout(height=300, margin=dict(l=00, r=00, t=00, b=00), showlegend=False)
 
-    if callback_trigger in ['toggle_uptime_filter', 'toggle_active_filter', 'hardware_version', 'date_filter', 'range_slider', 'street_name_dd', 'street_type_dd']:
 
-        # Create/update filtered traffic by start/end date
-        query = """
-        CREATE OR REPLACE TEMP TABLE filtered_traffic_dt AS
-        SELECT *
-        FROM filtered_traffic
-        WHERE STRPTIME(date, '%d-%m-%Y') >= ? AND STRPTIME(date, '%d-%m-%Y') <= ?
-        """
-        params = [start_date, end_date]
+    ### Create absolute line chart
+    group_cols = [radio_time_division, 'street_selection']
+    group_clause = ", ".join(group_cols)
+    # The counts are whole numbers, as 32 bit integers the line traces are encoded with half the bytes of doubles
+    query = f"""
+    SELECT 
+        {group_clause},
+        CAST(SUM(ped_total) AS UINTEGER) AS ped_total,
+        CAST(SUM(bike_total) AS UINTEGER) AS bike_total,
+        CAST(SUM(car_total) AS UINTEGER) AS car_total,
+        CAST(SUM(heavy_total) AS UINTEGER) AS heavy_total,
+    MIN(date_local) AS first_seen
+    FROM filtered_traffic_dt_str
+    GROUP BY {group_clause}
+    ORDER BY first_seen
+    """
 
-        query += 'AND hour >= ? AND hour <= ?'
-        params.append(hour_range[0])
-        params.append(hour_range[1])
-
-        with db_lock:  # Ensure thread safety for writes
-            conn.execute(query, params)
-
-        # Add selected street to filtered_traffic_dt table
-        add_selected_street('filtered_traffic_dt', id_street, street_name)
-
-    # Format dates for chart representation / processing
-
-    # if callback_trigger in ['date_filter']:
-    #     from_date_format = '%Y-%m-%dT%H:%M:%S'
-    # else:
-    #     from_date_format = '%Y-%m-%d'
-
-    to_date_format = '%d %b %Y'
-
-    # Align date formats
-    start_date = parser.parse(start_date)
-    end_date = parser.parse(end_date)
-    start_date_str = datetime.strftime(start_date, to_date_format)
-    end_date_str = datetime.strftime(end_date, to_date_format)
-
-    min_date_str = format_str_date(min_date, '%Y-%m-%dT%H:%M:%S', to_date_format)
-    max_date_str = format_str_date(max_date, '%Y-%m-%dT%H:%M:%S', to_date_format)
-
-    # Provide warnings in case of missing data
-    if missing_data:
-        # Add warnings to layout
-        date_range_text = _(message +', ' + _('available') + ': ' + min_date_str + _(' to ') + max_date_str)
-        if message == _('Dates out of range'):
-            selected_street_header_color = {'color': ADFC_crimson}
-            date_range_color = {'color': ADFC_crimson}
-        else:
-            selected_street_header_color = {'color': ADFC_orange}
-            date_range_color = {'color': ADFC_orange}
-    else:
-        # Street data range covered
-        selected_street_header_color = {'color': ADFC_green}
-        date_range_text = _('Pick date range:')
-        date_range_color = {'color': 'black'}
-
-    # Create pie chart
-    query = ('SELECT street_selection, '
-             'SUM(ped_total) AS ped_total, '
-             'SUM(bike_total) AS bike_total, '
-             'SUM(car_total) AS car_total, '
-             'SUM(heavy_total) AS heavy_total '
-             'FROM filtered_traffic_dt_str '
-             'WHERE street_selection = ? '
-             'GROUP BY street_selection')
-    params = [street_name]
-
-    with db_lock:  # Ensure thread safety for writes
-        df_pie = conn.execute(query, params).pl()
-
-    df_pie_traffic = df_pie[['ped_total', 'bike_total', 'car_total', 'heavy_total']]
-    df_pie_traffic_ren = df_pie_traffic.rename({'ped_total': _('Pedestrians'), 'bike_total': _('Bikes'), 'car_total': _('Cars'), 'heavy_total': _('Heavy')})
-    df_pie_traffic_sum = df_pie_traffic_ren.select(pl.all().sum())
-    df_pie_traffic_sum_T = df_pie_traffic_sum.transpose(
-        include_header=True,  # Keep original column names as first column
-        header_name="index",  # Name for the column containing original headers
-        column_names=["sum"]  # Name(s) for the new data column(s)
-    )
-
-    pie_traffic = px.pie(df_pie_traffic_sum_T, names='index', values='sum', color='index', height=300,
-    color_discrete_map={_('Pedestrians'): ADFC_lightblue, _('Bikes'): ADFC_green, _('Cars'): ADFC_orange, _('Heavy'): ADFC_crimson})
-
-    pie_traffic.update_layout(margin=dict(l=00, r=00, t=00, b=00))
-    pie_traffic.update_layout(showlegend=False)
-    pie_traffic.update_traces(textposition='inside', textinfo='percent+label')
-
-
-    ### Create absolute line chart
-    group_cols = [radio_time_division, 'street_selection']
-    group_clause = ", ".join(group_cols)
-    query = f"""
-    SELECT 
-        {group_clause},
-        SUM(ped_total) AS ped_total,
-        SUM(bike_total) AS bike_total,
-        SUM(car_total) AS car_total,
-        SUM(heavy_total) AS heavy_total,
-    MIN(date_local) AS first_seen
-    FROM filtered_traffic_dt_str
-    GROUP BY {group_clause}
-    ORDER BY first_seen
-    """
-
-    with db_lock:  # Ensure thread safety for writes
-        df_line_abs_traffic = conn.execute(query).pl()
+    df_line_abs_traffic = fetch_aggregate(query, (), data_key)
 
     line_abs_traffic = px.scatter(df_line_abs_traffic,
         x=radio_time_division, y=['ped_total', 'bike_total', 'car_total', 'heavy_total'],
         facet_col='street_selection',
         category_orders={'street_selection': [street_name, 'All Streets']},
-        labels={'year': _('Year'), 'year_month': _('Month'), 'year_week': _('Week'), 'date': _('Day'), 'date_hour': _('Hour')},
-        color_discrete_map={'ped_total': ADFC_lightblue, 'bike_total': ADFC_green, 'car_total': ADFC_orange, 'heavy_total': ADFC_crimson},
+        labels=time_division_labels,
+        color_discrete_map=TRAFFIC_TYPE_COLORS,
         facet_col_spacing=0.04,
-        title = (_('Absolute traffic count') + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)')
+        title = (_('Absolute traffic count') + title_suffix)
     ).update_traces(mode="lines+markers", connectgaps=False)
 
-    line_abs_traffic.update_layout({'plot_bgcolor': ADFC_palegrey, 'paper_bgcolor': ADFC_palegrey})
-    line_abs_traffic.update_layout(legend_title_text=_('Traffic Type'))
-    line_abs_traffic.update_layout(yaxis_title= _('Absolute traffic count'))
+    line_abs_traffic.update_layout(plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey, legend_title_text=traffic_type_title,
+                                   yaxis_title=_('Absolute traffic count'))
     line_abs_traffic.update_yaxes(matches=None)
     line_abs_traffic.update_xaxes(matches=None)
-    line_abs_traffic.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
-    line_abs_traffic.update_traces({'name': _('Pedestrians')}, selector={'name': 'ped_total'})
-    line_abs_traffic.update_traces({'name': _('Bikes')}, selector={'name': 'bike_total'})
-    line_abs_traffic.update_traces({'name': _('Cars')}, selector={'name': 'car_total'})
-    line_abs_traffic.update_traces({'name': _('Heavy')}, selector={'name': 'heavy_total'})
-    line_abs_traffic.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    line_abs_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ')')))
-    line_abs_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    for annotation in line_abs_traffic.layout.annotations: annotation['font'] = {'size': 14}
+    line_abs_traffic.update_yaxes(showticklabels=True)
+    line_abs_traffic.for_each_trace(lambda t: t.update(name=traffic_type_labels[t.name]))
+    line_abs_traffic.for_each_annotation(lambda a: a.update(text=facet_title(a.text, street_name, street_title), font_size=14))
     #Range Slider: line_abs_traffic.update_xaxes(rangeslider_visible=True)
 
-    ### Create average traffic bar chart by hour
-    group_cols = [radio_time_unit, 'street_selection']
-    group_clause = ", ".join(group_cols)
+    ### Averages by time unit, shared by the average traffic, car speed and v85 charts
+    cols = ['car_speed0', 'car_speed10', 'car_speed20', 'car_speed30', 'car_speed40', 'car_speed50', 'car_speed60', 'car_speed70']
+    sum_expr = " + ".join(cols)
+    avg_speed_expr = ",\n            ".join(f"ROUND(AVG({col}), 1) AS {col}" for col in cols)
+    perc_speed_expr = ",\n        ".join(f"ROUND({col} / total_speed * 100, 1) AS {col}_perc" for col in cols)
 
+    # One pass over the data for all averages, the speed percentages are taken from the rounded averages
     query = f"""
+    WITH grouped AS (
+        SELECT
+            {radio_time_unit},
+            street_selection,
+            ROUND(AVG(ped_total), 1) AS ped_total,
+            ROUND(AVG(bike_total), 1) AS bike_total,
+            ROUND(AVG(car_total), 1) AS car_total,
+            ROUND(AVG(heavy_total), 1) AS heavy_total,
+            {avg_speed_expr},
+            ROUND(MEAN(v85), 1) AS v85,
+        MIN(date_local) AS first_seen
+        FROM filtered_traffic_dt_str
+        GROUP BY {radio_time_unit}, street_selection
+    ),
+    totals AS (
+        SELECT
+            *,
+            {sum_expr} AS total_speed
+        FROM grouped
+    )
     SELECT
-        {group_clause},
-        ROUND(AVG(ped_total), 1) AS ped_total,
-        ROUND(AVG(bike_total), 1) AS bike_total,
-        ROUND(AVG(car_total), 1) AS car_total,
-        ROUND(AVG(heavy_total), 1) AS heavy_total,
-    MIN(date_local) AS first_seen
-    FROM filtered_traffic_dt_str
-    GROUP BY {group_clause}
+        {radio_time_unit},
+        street_selection,
+        ped_total,
+        bike_total,
+        car_total,
+        heavy_total,
+        v85,
+        total_speed,
+        {perc_speed_expr}
+    FROM totals
     ORDER BY first_seen
     """
 
@@ -977,8 +940,10 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
     # or:
     # EXTRACT(MONTH FROM date_local) AS unit
 
-    with db_lock:  # Ensure thread safety for writes
-        pl_avg_traffic_hr = conn.execute(query).pl()
+    df_unit_averages = fetch_aggregate(query, (), data_key)
+
+    ### Create average traffic bar chart by hour
+    pl_avg_traffic_hr = df_unit_averages.select(radio_time_unit, 'street_selection', 'ped_total', 'bike_total', 'car_total', 'heavy_total')
 
     bar_avg_traffic_hr = px.bar(pl_avg_traffic_hr,
         x=radio_time_unit, y=['ped_total', 'bike_total', 'car_total', 'heavy_total'],
@@ -986,24 +951,17 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
         facet_col='street_selection',
         facet_col_spacing=0.04,
         category_orders={'street_selection': [street_name, 'All Streets']},
-        labels={'year': _('Year'), 'month': _('Month'), 'weekday': _('Week'), 'day': _('Day'), 'hour': _('Hour')},
-        color_discrete_map={'ped_total': ADFC_lightblue, 'bike_total': ADFC_green, 'car_total': ADFC_orange, 'heavy_total': ADFC_crimson},
-        title=(_('Average traffic count per hour')  + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)')
+        labels=time_unit_labels,
+        color_discrete_map=TRAFFIC_TYPE_COLORS,
+        title=(_('Average traffic count per hour') + title_suffix)
     )
 
-    bar_avg_traffic_hr.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ')')))
-    bar_avg_traffic_hr.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    bar_avg_traffic_hr.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    bar_avg_traffic_hr.update_layout({'plot_bgcolor': ADFC_palegrey,'paper_bgcolor': ADFC_palegrey})
-    bar_avg_traffic_hr.update_layout(yaxis_title=_('Average traffic count per hour'))
-    bar_avg_traffic_hr.update_layout(legend_title_text=_('Traffic Type'))
-    bar_avg_traffic_hr.update_traces({'name': _('Pedestrians')}, selector={'name': 'ped_total'})
-    bar_avg_traffic_hr.update_traces({'name': _('Bikes')}, selector={'name': 'bike_total'})
-    bar_avg_traffic_hr.update_traces({'name': _('Cars')}, selector={'name': 'car_total'})
-    bar_avg_traffic_hr.update_traces({'name': _('Heavy')}, selector={'name': 'heavy_total'})
+    bar_avg_traffic_hr.for_each_annotation(lambda a: a.update(text=facet_title(a.text, street_name, street_title), font_size=14))
+    bar_avg_traffic_hr.update_layout(plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey, yaxis_title=_('Average traffic count per hour'),
+                                     legend_title_text=traffic_type_title)
+    bar_avg_traffic_hr.for_each_trace(lambda t: t.update(name=traffic_type_labels[t.name]))
     bar_avg_traffic_hr.update_xaxes(dtick = 1, tickformat=".0f")
-    bar_avg_traffic_hr.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
-    for annotation in bar_avg_traffic_hr.layout.annotations: annotation['font'] = {'size': 14}
+    bar_avg_traffic_hr.update_yaxes(showticklabels=True)
 
     ### Create average traffic bar chart by time_div
     radio_time_unit_to_time_div = {
@@ -1018,28 +976,21 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
 
     time_div = radio_time_unit_to_time_div.get(radio_time_unit)
 
-    # Step 1: create temp table with sums and time_div
-    query = f"""
-    CREATE OR REPLACE TEMP TABLE step_1 AS
-    SELECT
-        {time_div},
-        {radio_time_unit},
-        street_selection,
-        SUM(ped_total) AS ped_total,
-        SUM(bike_total) AS bike_total,
-        SUM(car_total) AS car_total,
-        SUM(heavy_total) AS heavy_total,
-    MIN(date_local) AS first_seen
-    FROM filtered_traffic_dt_str
-    GROUP BY {time_div}, {radio_time_unit}, street_selection
-    ORDER BY first_seen
-    """
-
-    with db_lock:  # Ensure thread safety for writes
-        conn.execute(query)
-
-    # Step 2: generate averages by time_div
+    # Step 1: sums by time_div, step 2: averages of these sums by radio_time_unit
     query = f"""
+    WITH step_1 AS (
+        SELECT
+            {time_div},
+            {radio_time_unit},
+            street_selection,
+            SUM(ped_total) AS ped_total,
+            SUM(bike_total) AS bike_total,
+            SUM(car_total) AS car_total,
+            SUM(heavy_total) AS heavy_total,
+        MIN(date_local) AS first_seen
+        FROM filtered_traffic_dt_str
+        GROUP BY {time_div}, {radio_time_unit}, street_selection
+    )
     SELECT
         {radio_time_unit},
         street_selection,
@@ -1053,11 +1004,7 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
     ORDER BY first_seen
     """
 
-    with db_lock:  # Ensure thread safety for writes
-        pl_avg_traffic = conn.execute(query).pl()
-
-        # Delete (drop) the street_selection table
-        conn.execute('DROP TABLE IF EXISTS step_1')
+    pl_avg_traffic = fetch_aggregate(query, (), data_key)
 
     bar_avg_traffic = px.bar(pl_avg_traffic,
         x=radio_time_unit, y=['ped_total', 'bike_total', 'car_total', 'heavy_total'],
@@ -1065,98 +1012,36 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
         facet_col='street_selection',
         facet_col_spacing=0.04,
         category_orders={'street_selection': [street_name, 'All Streets']},
-        labels={'year': _('Year'), 'month': _('Month'), 'weekday': _('Week'), 'day': _('Day'), 'hour': _('Hour')},
-        color_discrete_map={'ped_total': ADFC_lightblue, 'bike_total': ADFC_green, 'car_total': ADFC_orange, 'heavy_total': ADFC_crimson},
-        title=(_('Average traffic count per ') + _(radio_time_unit) + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)')
+        labels=time_unit_labels,
+        color_discrete_map=TRAFFIC_TYPE_COLORS,
+        title=(_('Average traffic count per ') + _(radio_time_unit) + title_suffix)
     )
 
-    bar_avg_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ')')))
-    bar_avg_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    bar_avg_traffic.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    bar_avg_traffic.update_layout({'plot_bgcolor': ADFC_palegrey,'paper_bgcolor': ADFC_palegrey})
-    bar_avg_traffic.update_layout(yaxis_title=_('Average traffic count per ') + _(radio_time_unit))
+    bar_avg_traffic.for_each_annotation(lambda a: a.update(text=facet_title(a.text, street_name, street_title), font_size=14))
+    bar_avg_traffic.update_layout(plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey, yaxis_title=_('Average traffic count per ') + _(radio_time_unit),
+                                  legend_title_text=traffic_type_title)
     bar_avg_traffic.update_yaxes(matches=None)
-    bar_avg_traffic.update_layout(legend_title_text=_('Traffic Type'))
-    bar_avg_traffic.update_traces({'name': _('Pedestrians')}, selector={'name': 'ped_total'})
-    bar_avg_traffic.update_traces({'name': _('Bikes')}, selector={'name': 'bike_total'})
-    bar_avg_traffic.update_traces({'name': _('Cars')}, selector={'name': 'car_total'})
-    bar_avg_traffic.update_traces({'name': _('Heavy')}, selector={'name': 'heavy_total'})
+    bar_avg_traffic.for_each_trace(lambda t: t.update(name=traffic_type_labels[t.name]))
     bar_avg_traffic.update_xaxes(dtick = 1, tickformat=".0f")
-    bar_avg_traffic.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
-    for annotation in bar_avg_traffic.layout.annotations: annotation['font'] = {'size': 14}
+    bar_avg_traffic.update_yaxes(showticklabels=True)
 
     ### Create percentage speed bar chart
-    cols = ['car_speed0', 'car_speed10', 'car_speed20', 'car_speed30', 'car_speed40', 'car_speed50', 'car_speed60', 'car_speed70']
-    sum_expr = " + ".join(cols)
-
-    query = f"""
-    WITH grouped AS (
-        SELECT
-            {radio_time_unit},
-            street_selection,
-            ROUND(AVG(car_speed0), 1)  AS car_speed0,
-            ROUND(AVG(car_speed10), 1) AS car_speed10,
-            ROUND(AVG(car_speed20), 1) AS car_speed20,
-            ROUND(AVG(car_speed30), 1) AS car_speed30,
-            ROUND(AVG(car_speed40), 1) AS car_speed40,
-            ROUND(AVG(car_speed50), 1) AS car_speed50,
-            ROUND(AVG(car_speed60), 1) AS car_speed60,
-            ROUND(AVG(car_speed70), 1) AS car_speed70,
-        MIN(date_local) AS first_seen
-        FROM filtered_traffic_dt_str
-        GROUP BY {radio_time_unit}, street_selection
-        ORDER BY first_seen
-    ),
-    totals AS (
-        SELECT
-            *,
-            car_speed0 + car_speed10 + car_speed20 + car_speed30 +
-            car_speed40 + car_speed50 + car_speed60 + car_speed70
-            AS total_speed
-        FROM grouped
-        WHERE ({sum_expr}) > 0 
-    )
-    SELECT
-        {radio_time_unit},
-        street_selection,
-        ROUND(car_speed0  / total_speed * 100, 1) AS car_speed0,
-        ROUND(car_speed10 / total_speed * 100, 1) AS car_speed10,
-        ROUND(car_speed20 / total_speed * 100, 1) AS car_speed20,
-        ROUND(car_speed30 / total_speed * 100, 1) AS car_speed30,
-        ROUND(car_speed40 / total_speed * 100, 1) AS car_speed40,
-        ROUND(car_speed50 / total_speed * 100, 1) AS car_speed50,
-        ROUND(car_speed60 / total_speed * 100, 1) AS car_speed60,
-        ROUND(car_speed70 / total_speed * 100, 1) AS car_speed70
-    FROM totals
-    """
-
-    with db_lock:  # Ensure thread safety for writes
-        df_bar_speed_traffic = conn.execute(query).pl()
-
-    # Prepare max speed color maps
-    color_map_50 = {'car_speed0': ADFC_lightgrey, 'car_speed10': ADFC_lightblue_D,
-     'car_speed20': ADFC_lightblue, 'car_speed30': ADFC_green,
-     'car_speed40': ADFC_green_L, 'car_speed50': ADFC_orange,
-     'car_speed60': ADFC_crimson, 'car_speed70': ADFC_pink}
-
-    color_map_30 = {'car_speed0': ADFC_lightgrey, 'car_speed10': ADFC_green_L,
-     'car_speed20': ADFC_green, 'car_speed30': ADFC_orange_L,
-     'car_speed40': ADFC_orange, 'car_speed50': ADFC_pink,
-     'car_speed60': ADFC_red, 'car_speed70': ADFC_crimson}
+    df_bar_speed_traffic = (df_unit_averages.filter(pl.col('total_speed') > 0)
+                            .select(radio_time_unit, 'street_selection', *[pl.col(col + '_perc').alias(col) for col in cols]))
 
     # Get maximum speed for the selected street and set color map
-    maxspeed = str(df_map.loc[df_map['segment_id'] == segment_id ]['osm.maxspeed'].iloc[0])
+    maxspeed = str(segment_info[segment_id]['osm.maxspeed'])
 
     # Show max speed logo
     if maxspeed == '30':
-        speed_color_map = color_map_30
+        speed_color_map = CAR_SPEED_COLORS_30
         max_speed_logo = '\\assets\\30.png'
     elif maxspeed == "['50', '30']":
-        speed_color_map = color_map_30
+        speed_color_map = CAR_SPEED_COLORS_30
         maxspeed = '30 / 50'
         max_speed_logo = '\\assets\\30.png' #!change if used
     else:
-        speed_color_map = color_map_50
+        speed_color_map = CAR_SPEED_COLORS_50
         max_speed_logo = '\\assets\\50.png'
 
     #path_to_speed_logo = os.path.join(ASSET_DIR, max_speed_logo)
@@ -1166,16 +1051,15 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
         barmode='stack',
         facet_col='street_selection',
         category_orders={'street_selection': [street_name, 'All Streets']},
-        labels={'year': _('Year'), 'month': _('Month'), 'weekday': _('Week'), 'day': _('Day'), 'hour': _('Hour')},
+        labels=time_unit_labels,
         color_discrete_map=speed_color_map,
         facet_col_spacing=0.04,
-        title=(_('Average car speed %') + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)')
+        title=(_('Average car speed %') + title_suffix)
     )
 
-    bar_perc_speed.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    bar_perc_speed.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ', max ' + maxspeed + ' km/h)')))
-    bar_perc_speed.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    bar_perc_speed.update_layout(legend_title_text=_('Car speed'))
+    bar_perc_speed.for_each_annotation(lambda a: a.update(text=facet_title(a.text, street_name, street_name + segment_label + segment_id + ', max ' + maxspeed + ' km/h)'), font_size=14))
+    bar_perc_speed.update_layout(legend_title_text=_('Car speed'), plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey,
+                                 yaxis_title=_('Average car speed %'))
     # bar_perc_speed.add_layout_image(
     #     dict(
     #         source=max_speed_logo,
@@ -1188,59 +1072,37 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
     #         layer='above'
     #     )
     # )
-    bar_perc_speed.update_traces({'name': '0 - 10 km/h'}, selector={'name': 'car_speed0'})
-    bar_perc_speed.update_traces({'name': '10 - 20 km/h'}, selector={'name': 'car_speed10'})
-    bar_perc_speed.update_traces({'name': '20 - 30 km/h'}, selector={'name': 'car_speed20'})
-    bar_perc_speed.update_traces({'name': '30 - 40 km/h'}, selector={'name': 'car_speed30'})
-    bar_perc_speed.update_traces({'name': '40 - 50 km/h'}, selector={'name': 'car_speed40'})
-    bar_perc_speed.update_traces({'name': '50 - 60 km/h'}, selector={'name': 'car_speed50'})
-    bar_perc_speed.update_traces({'name': '60 - 70 km/h'}, selector={'name': 'car_speed60'})
-    bar_perc_speed.update_traces({'name': '70 - 80 km/h'}, selector={'name': 'car_speed70'})
-    bar_perc_speed.update_layout({'plot_bgcolor': ADFC_palegrey, 'paper_bgcolor': ADFC_palegrey})
-    bar_perc_speed.update_layout(yaxis_title=_('Average car speed %'))
-    bar_perc_speed.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
-    for annotation in bar_perc_speed.layout.annotations:
-        annotation['font'] = {'size': 14}
+    bar_perc_speed.for_each_trace(lambda t: t.update(name=CAR_SPEED_LABELS[t.name]))
+    bar_perc_speed.update_yaxes(showticklabels=True)
 
     ### Create v85 bar graph
-
-    group_cols = [radio_time_unit, 'street_selection']
-    group_clause = ", ".join(group_cols)
-    query = f"""
-    SELECT 
-        {group_clause},
-        ROUND(MEAN(v85), 1) AS v85,
-    MIN(date_local) AS first_seen
-    FROM filtered_traffic_dt_str
-    GROUP BY {group_clause}
-    ORDER BY first_seen
-    """
-
-    with db_lock:  # Ensure thread safety for writes
-        df_bar_v85 = conn.execute(query).pl()
-
-    bar_v85 = px.bar(df_bar_v85,
-        x=radio_time_unit, y='v85',
-        color='v85',
-        color_continuous_scale='temps',
-        facet_col='street_selection',
-        category_orders={'street_selection': [street_name, 'All Streets']},
-        facet_col_spacing=0.04,
-        labels={'year': _('Year'), 'month': _('Month'), 'weekday': _('Week'), 'day': _('Day'), 'hour': _('Hour')},
-        title=(_('Speed cars v85') + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)')
-    )
-
-    bar_v85.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    bar_v85.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ')')))
-    bar_v85.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    bar_v85.update_layout(legend_title_text=_('Traffic Type'))
-    bar_v85.update_layout({'plot_bgcolor': ADFC_palegrey,'paper_bgcolor': ADFC_palegrey})
-    bar_v85.update_layout(yaxis_title= _('v85 in km/h'))
+    df_bar_v85 = df_unit_averages.select(radio_time_unit, 'street_selection', 'v85')
+    # Color the bars here over the v85 range of both facets, like a shared color axis, so plotly.js does not need to map them
+    v85_min = df_bar_v85['v85'].min() or 0
+    v85_span = (df_bar_v85['v85'].max() or 0) - v85_min or 1
+    df_bar_v85 = df_bar_v85.with_columns(((pl.col('v85') - v85_min) / v85_span).fill_null(0).alias('v85_color'))
+
+    # Build the facets directly with graph objects, this skips the plotly express data frame processing
+    facet_titles = {street_name: street_title, 'All Streets': all_streets_label}
+    facets = [facet for facet in facet_titles if facet in df_bar_v85['street_selection'].cast(pl.String)]
+    x_label = time_unit_labels.get(radio_time_unit, radio_time_unit)
+    bar_v85 = make_subplots(rows=1, cols=max(len(facets), 1), shared_yaxes=True, horizontal_spacing=0.04,
+                            subplot_titles=[facet_titles[facet] for facet in facets])
+    for col, facet in enumerate(facets, start=1):
+        df_facet = df_bar_v85.filter(pl.col('street_selection').cast(pl.String) == facet)
+        bar_v85.add_trace(go.Bar(x=df_facet[radio_time_unit].to_numpy(), y=df_facet['v85'].to_numpy(), name='', showlegend=False,
+                                 marker_color=sample_colorscale('temps', df_facet['v85_color'].to_list()),
+                                 hovertemplate=x_label + '=%{x}<br>v85=%{y}<extra></extra>'), row=1, col=col)
+    bar_v85.update_xaxes(title_text=x_label)
+    bar_v85.update_xaxes(matches='x', col=2)
+    bar_v85.update_layout(title_text=_('Speed cars v85') + title_suffix,
+                          barmode='relative',
+                          legend_title_text=traffic_type_title, plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey,
+                          yaxis_title=_('v85 in km/h'))
     bar_v85.update_xaxes(dtick=1, tickformat=".0f")
     bar_v85.update_yaxes(dtick=5, tickformat=".0f")
-    bar_v85.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
-    for annotation in bar_v85.layout.annotations:
-        annotation['font'] = {'size': 14}
+    bar_v85.update_yaxes(showticklabels=True)
+    bar_v85.update_annotations(font_size=14)
 
     ### Create ranking chart
     group_cols = ['id_street', 'street_selection']
@@ -1248,48 +1110,261 @@ def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_d
     query = f"""
     SELECT 
         {group_clause},
-        SUM(ped_total) AS ped_total,
-        SUM(bike_total) AS bike_total,
-        SUM(car_total) AS car_total,
-        SUM(heavy_total) AS heavy_total,
+        CAST(SUM(ped_total) AS UINTEGER) AS ped_total,
+        CAST(SUM(bike_total) AS UINTEGER) AS bike_total,
+        CAST(SUM(car_total) AS UINTEGER) AS car_total,
+        CAST(SUM(heavy_total) AS UINTEGER) AS heavy_total,
     MIN(date_local) AS first_seen
     FROM filtered_traffic_dt
     GROUP BY {group_clause}
     ORDER BY {radio_y_axis} DESC
     """
 
-    # Add or update table filtered_traffic_dt (for ranking chart)
-    with db_lock:  # Ensure thread safety for writes
-        df_bar_ranking = conn.execute(query).fetch_df()
+    df_bar_ranking = fetch_aggregate(query, (), data_key)
 
     # Remove '90000' from the labels to reduce x-labels space required
-    df_bar_ranking['x-labels'] = df_bar_ranking['id_street'].copy()
-    df_bar_ranking['x-labels'] = df_bar_ranking['x-labels'].astype('string')
-    df_bar_ranking['x-labels'] = df_bar_ranking['x-labels'].str.replace('90000', '')
+    df_bar_ranking = df_bar_ranking.with_columns(pl.col('id_street').cast(pl.String).str.replace('90000', '', literal=True).alias('x-labels'))
 
     # Assess x and y for annotation
     #if not missing_data:
-    annotation_index = df_bar_ranking[df_bar_ranking['id_street'] == id_street].index[0]
-    annotation_x = annotation_index
-    annotation_y = df_bar_ranking[radio_y_axis].values[annotation_x]
-
-    bar_ranking = px.bar(df_bar_ranking,
-        x='x-labels', y=radio_y_axis,
-        color=radio_y_axis,
-        hover_data={'ped_total': True, 'bike_total': True, 'car_total': True, 'heavy_total': True, 'id_street': True},
-        color_continuous_scale='temps',
-        labels={'ped_total': _('Pedestrians'), 'bike_total': _('Bikes'), 'car_total': _('Cars'), 'heavy_total': _('Heavy'), 'id_street': _('Street (segment id)')},
-        title=(_('Absolute traffic') + ' (' + start_date_str + ' - ' + end_date_str + ', ' + str(hour_range[0]) + ' - ' + str(hour_range[1]) + ' h)'),
-        height=600,
-    )
+    # The selected street may have no data for the selected period, then there is nothing to point at
+    street_mask = df_bar_ranking['id_street'] == id_street
+    if street_mask.any():
+        annotation_x = street_mask.arg_max()
+        annotation_y = df_bar_ranking[radio_y_axis][annotation_x]
+
+    # One bar per segment, built directly with the arrays instead of through px.bar, the bars are colored by their height
+    hover_cols = [col for col in traffic_type_labels if col != radio_y_axis]
+    hover_labels = [traffic_type_labels[col] for col in hover_cols] + [_('Street (segment id)')]
+    y_values = df_bar_ranking[radio_y_axis].to_numpy()
+    bar_ranking = go.Figure(go.Bar(x=df_bar_ranking['x-labels'].to_numpy(), y=y_values, name='', showlegend=False,
+                                   marker=dict(color=y_values, colorscale='temps', showscale=True, colorbar_title_text=traffic_type_labels[radio_y_axis]),
+                                   customdata=df_bar_ranking.select(*hover_cols, pl.col('id_street').cast(pl.String)).to_numpy(),
+                                   hovertemplate='x-labels=%{x}<br>' + traffic_type_labels[radio_y_axis] + '=%{y}<br>' +
+                                                 '<br>'.join(f'{label}=%{{customdata[{i}]}}' for i, label in enumerate(hover_labels)) + '<extra></extra>'))
+    bar_ranking.update_layout(title_text=_('Absolute traffic') + title_suffix, height=600, xaxis_title='x-labels')
+
+    if street_mask.any():
+        bar_ranking.add_annotation(x=annotation_x, y=annotation_y, text= street_name + '<br>' + segment_label + segment_id + ')', showarrow=True)
+    bar_ranking.update_annotations(ax=0, ay=-40, arrowhead=2, arrowsize=2, arrowwidth = 1, arrowcolor= ADFC_darkgrey, xanchor='left', font_size=14)
+    bar_ranking.update_layout(legend_title_text=traffic_type_title, plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey,
+                              yaxis_title=_('Absolute count'))
+
+    # Cache the figures in their JSON form, so Dash does not need to encode the arrays again on every response
+    figures = pie_traffic, line_abs_traffic, bar_avg_traffic_hr, bar_avg_traffic, bar_perc_speed, bar_v85, bar_ranking
+    return tuple(json.loads(figure.to_json()) for figure in figures)
 
-    bar_ranking.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    bar_ranking.add_annotation(x=annotation_x, y=annotation_y, text= street_name + '<br>' + _(' (segment:') + segment_id + ')', showarrow=True)
-    bar_ranking.update_annotations(ax=0, ay=-40, arrowhead=2, arrowsize=2, arrowwidth = 1, arrowcolor= ADFC_darkgrey, xanchor='left')
-    bar_ranking.update_layout(legend_title_text=_('Traffic Type'))
-    bar_ranking.update_layout({'plot_bgcolor': ADFC_palegrey,'paper_bgcolor': ADFC_palegrey})
-    bar_ranking.update_layout(yaxis_title= _('Absolute count'))
-    for annotation in bar_ranking.layout.annotations: annotation['font'] = {'size': 14}
+### General traffic callback ###
+@callback(
+    Output(component_id='selected_street_header', component_property='children'),
+    Output(component_id='selected_street_header', component_property='style'),
+    Output(component_id='street_id_text', component_property='children'),
+    Output(component_id='date_range_text', component_property='children'),
+    Output(component_id="date_filter", component_property="start_date", allow_duplicate=True),
+    Output(component_id="date_filter", component_property="end_date", allow_duplicate=True),
+    Output(component_id="date_filter", component_property="min_date_allowed"),
+    Output(component_id="date_filter", component_property="max_date_allowed"),
+    Output(component_id='date_range_text', component_property='style'),
+    Output(component_id='pie_traffic', component_property='figure'),
+    Output(component_id='line_abs_traffic', component_property='figure'),
+    Output(component_id='bar_avg_traffic_hr', component_property='figure'),
+    Output(component_id='bar_avg_traffic', component_property='figure'),
+    Output(component_id='bar_perc_speed', component_property='figure'),
+    Output(component_id='bar_v85', component_property='figure'),
+    Output(component_id='bar_ranking', component_property='figure'),
+    Input(component_id='radio_time_division', component_property='value'),
+    Input(component_id='radio_time_unit', component_property='value'),
+    Input(component_id='street_name_dd', component_property='value'),
+    Input(component_id='street_type_dd', component_property='value'),
+    Input(component_id="date_filter", component_property="start_date"),
+    Input(component_id="date_filter", component_property="end_date"),
+    Input(component_id='range_slider', component_property='value'),
+    Input(component_id='toggle_uptime_filter', component_property='value'),
+    Input(component_id='toggle_active_filter', component_property='value'),
+    Input(component_id='hardware_version', component_property='value'),
+    Input(component_id='radio_y_axis', component_property='value'),
+    Input(component_id='language_selector', component_property='value'),
+    Input(component_id='toggle_map_style', component_property='value'),
+    prevent_initial_call='initial_duplicate',
+)
+
+def update_graphs(radio_time_division, radio_time_unit, id_street, street_type_dd, start_date, end_date, hour_range, toggle_uptime_filter, toggle_active_filter, hardware_version, radio_y_axis, lang_code_dd, toggle_map_style):
+    global filtered_traffic_key, filtered_traffic_dt_key
+
+    callback_trigger = ctx.triggered_id
+
+    # Avoid chart refresh when map refresh only is needed
+    if callback_trigger == 'toggle_map_style':
+        return dash.no_update
+
+    # Get segment_id/street name
+    segment_id = id_street[-11:-1]
+    street_id_text = _('Selected segment ID: ') + str(segment_id)
+    street_name = id_street.split(' (')[0]
+    selected_street_header = street_name
+
+    #TODO: First callback triggers "hardware version"?
+    ### Filter all traffic
+    # The temp tables are shared by all sessions, so rebuild them whenever they were built for another selection,
+    # not only when a filter triggered this callback
+    filter_key = (tuple(toggle_uptime_filter), tuple(toggle_active_filter), tuple(hardware_version), street_type_dd)
+    if filter_key != filtered_traffic_key:
+
+        # Leave out the columns only needed for filtering right away instead of copying the table a second time
+        query = ('CREATE OR REPLACE TEMP TABLE filtered_traffic AS '
+                 'SELECT * EXCLUDE (uptime, hardware_version, last_data_package_naive) '
+                 'FROM all_traffic ')
+        params = []
+
+        # Filter all_traffic
+        if toggle_uptime_filter == ['filter_uptime_selected']:
+            # Filter uptime
+            query += 'WHERE uptime > 0.7 '
+            if toggle_active_filter == ['filter_active_selected']:
+                # Filter active cameras
+                query += 'AND CAST(last_data_package_naive AS DATE) >= ? '
+                params = [two_weeks_ago]
+            if hardware_version == [1]:
+                query += 'AND hardware_version = 1 '
+            elif hardware_version == [2]:
+                query += 'AND hardware_version = 2 '
+            if street_type_dd == 'primary':
+                query += 'AND street_type = ? '
+                params.append('primary')
+            elif street_type_dd == 'secondary':
+                query += 'AND street_type = ? '
+                params.append('secondary')
+            elif street_type_dd == 'tertiary':
+                query += 'AND street_type = ? '
+                params.append('tertiary')
+            elif street_type_dd == 'residential':
+                query += 'AND street_type = ? '
+                params.append('residential')
+        else:
+            # Filter active selected
+            if toggle_active_filter == ['filter_active_selected']:
+                query += 'WHERE CAST(last_data_package_naive AS DATE) >= ? '
+                params = [two_weeks_ago]
+                if hardware_version == [1]:
+                    query += 'AND hardware_version = 1 '
+                elif hardware_version == [2]:
+                    query += 'AND hardware_version = 2 '
+                if street_type_dd == 'primary':
+                    query += 'AND street_type = ? '
+                    params.append('primary')
+                elif street_type_dd == 'secondary':
+                    query += 'AND street_type = ? '
+                    params.append('secondary')
+                elif street_type_dd == 'tertiary':
+                    query += 'AND street_type = ? '
+                    params.append('tertiary')
+                elif street_type_dd == 'residential':
+                    query += 'AND street_type = ? '
+                    params.append('residential')
+            else:
+                if hardware_version == [1]:
+                    query += 'WHERE hardware_version = 1 '
+                elif hardware_version == [2]:
+                    query += 'WHERE hardware_version = 2 '
+                if street_type_dd == 'primary':
+                    query += 'AND street_type = ? '
+                    params.append('primary')
+                elif street_type_dd == 'secondary':
+                    query += 'AND street_type = ? '
+                    params.append('secondary')
+                elif street_type_dd == 'tertiary':
+                    query += 'AND street_type = ? '
+                    params.append('tertiary')
+                elif street_type_dd == 'residential':
+                    query += 'AND street_type = ? '
+                    params.append('residential')
+
+        # Add or update table filtered_traffic
+        with db_lock:  # Ensure thread safety for writes
+            conn.execute(query, params)
+            filtered_traffic_key = filter_key
+
+    # Check if selected street has data for selected data range
+    min_date, max_date, start_date, end_date, message, missing_data = get_min_max_str(start_date, end_date, id_street, 'filtered_traffic', filter_key)
+
+    # The slider goes up to 24, clamp to the existing hours 0-23 so the selection is never empty
+    first_hour = min(hour_range[0], 23)
+    last_hour = min(max(hour_range[1], first_hour), 23)
+
+    # Create/update filtered traffic by start/end date
+    query = """
+    CREATE OR REPLACE TEMP TABLE filtered_traffic_dt AS
+    SELECT *
+    FROM filtered_traffic
+    WHERE date_local >= ? AND date_local < ?
+    """
+    params = list(get_day_range(start_date, end_date))
+
+    # Only filter hours if the range does not cover the complete day
+    if first_hour > 0 or last_hour < 23:
+        query += 'AND hour BETWEEN ? AND ?'
+        params.append(first_hour)
+        params.append(last_hour)
+
+    with db_lock:  # Ensure thread safety for writes
+        # Selection the filtered tables are based on, used as key for the aggregate cache. It is taken under
+        # the lock, so it matches the filtered_traffic table the date filter reads from.
+        data_key = (filtered_traffic_key, id_street, start_date, end_date, first_hour, last_hour)
+        if data_key != filtered_traffic_dt_key:
+            conn.execute(query, params)
+            # Add selected street to filtered_traffic_dt table
+            add_selected_street('filtered_traffic_dt', id_street, street_name)
+            filtered_traffic_dt_key = data_key
+        # Key of the tables as they are now, the charts below are cached under it
+        table_key = filtered_traffic_dt_key
+
+    # Format dates for chart representation / processing
+
+    # if callback_trigger in ['date_filter']:
+    #     from_date_format = '%Y-%m-%dT%H:%M:%S'
+    # else:
+    #     from_date_format = '%Y-%m-%d'
+
+    to_date_format = '%d %b %Y'
+
+    # Align date formats
+    start_date = parser.parse(start_date)
+    end_date = parser.parse(end_date)
+    start_date_str = datetime.strftime(start_date, to_date_format)
+    end_date_str = datetime.strftime(end_date, to_date_format)
+
+    min_date_str = format_str_date(min_date, '%Y-%m-%dT%H:%M:%S', to_date_format)
+    max_date_str = format_str_date(max_date, '%Y-%m-%dT%H:%M:%S', to_date_format)
+
+    # Provide warnings in case of missing data
+    if missing_data:
+        # Add warnings to layout
+        date_range_text = _(message +', ' + _('available') + ': ' + min_date_str + _(' to ') + max_date_str)
+        if message == _('Dates out of range'):
+            selected_street_header_color = {'color': ADFC_crimson}
+            date_range_color = {'color': ADFC_crimson}
+        else:
+            selected_street_header_color = {'color': ADFC_orange}
+            date_range_color = {'color': ADFC_orange}
+    else:
+        # Street data range covered
+        selected_street_header_color = {'color': ADFC_green}
+        date_range_text = _('Pick date range:')
+        date_range_color = {'color': 'black'}
+
+    pie_traffic, line_abs_traffic, bar_avg_traffic_hr, bar_avg_traffic, bar_perc_speed, bar_v85, bar_ranking = create_graphs(
+        table_key, id_street, start_date_str, end_date_str, tuple(hour_range), radio_time_division, radio_time_unit, radio_y_axis, language)
+
+    # The chart settings only change their own charts, everything else is already up to date in the browser
+    if callback_trigger == 'radio_time_division':
+        pie_traffic = bar_avg_traffic_hr = bar_avg_traffic = bar_perc_speed = bar_v85 = bar_ranking = dash.no_update
+    elif callback_trigger == 'radio_time_unit':
+        pie_traffic = line_abs_traffic = bar_ranking = dash.no_update
+    elif callback_trigger == 'radio_y_axis':
+        pie_traffic = line_abs_traffic = bar_avg_traffic_hr = bar_avg_traffic = bar_perc_speed = bar_v85 = dash.no_update
+    if callback_trigger in ['radio_time_division', 'radio_time_unit', 'radio_y_axis']:
+        selected_street_header = selected_street_header_color = street_id_text = date_range_text = dash.no_update
+        start_date = end_date = min_date = max_date = date_range_color = dash.no_update
 
     return selected_street_header, selected_street_header_color, street_id_text, date_range_text, start_date, end_date, min_date, max_date, date_range_color, pie_traffic, line_abs_traffic, bar_avg_traffic_hr, bar_avg_traffic, bar_perc_speed, bar_v85, bar_ranking
 
@@ -1369,9 +1444,6 @@ def update_period_other_values(period_values_year, period_type_others, street_id
 def comparison_chart(period_values_year, period_options_year,
                      period_type_others, period_values_others, period_options_others, id_street, min_date, max_date):
 
-    segment_id = id_street[-11:-1]
-    street_name = id_street.split(' (')[0]
-
     if not period_values_others or len(period_values_others) != 2:
         select_two_color = {'color': ADFC_orange}
         select_two_text = _('Select (exactly) two periods to compare:')
@@ -1381,32 +1453,16 @@ def comparison_chart(period_values_year, period_options_year,
         select_two_text = _('Select two periods to compare:')
         select_two_color = {'color': 'black'}
 
-    # Add selected street to filtered_traffic
-    add_selected_street('filtered_traffic', id_street, street_name)
-    # Exclude speed columns to reduce size
-    conn.execute('CREATE OR REPLACE TEMP TABLE filtered_traffic_str AS '
-                 'SELECT * EXCLUDE (car_speed0, car_speed10, car_speed20, car_speed30, car_speed40, car_speed50, car_speed60, car_speed70, v85) '
-                 'FROM filtered_traffic_str')
-
-    # Create period A and B, based on period_type and values
-    query_A = (f'CREATE OR REPLACE TEMP TABLE df_period_A AS '
-               f'SELECT * '
-               f'FROM filtered_traffic_str '
-               f'WHERE {period_type_others} = ? '
-               f'AND date_local >= ? AND date_local <= ?')
-
-    params_A = [period_values_others[0], min_date, max_date]
-
-    query_B = (f'CREATE OR REPLACE TEMP TABLE df_period_B AS '
-               f'SELECT * '
-               f'FROM filtered_traffic_str '
-               f'WHERE {period_type_others} = ? '
-               f'AND date_local >= ? AND date_local <= ?')
-    params_B = [period_values_others[1], min_date, max_date]
+    line_avg_delta_traffic = create_comparison_chart(filtered_traffic_key, id_street, period_type_others, tuple(period_values_others),
+                                                     min_date, max_date, language)
 
-    with db_lock:
-        conn.execute(query_A, params_A)
-        conn.execute(query_B, params_B)
+    return line_avg_delta_traffic, select_two_text, select_two_color
+
+@lru_cache(maxsize=16)
+def create_comparison_chart(filter_key, id_street, period_type_others, period_values_others, min_date, max_date, lang_code):
+    # filter_key identifies the filtered_traffic table the periods are taken from, see update_graphs
+    segment_id = id_street[-11:-1]
+    street_name = id_street.split(' (')[0]
 
     # Prepare grouping and graph labels
     if period_type_others == _('year_month'):
@@ -1422,61 +1478,50 @@ def comparison_chart(period_values_year, period_options_year,
         group_by = _('month')
         label = _('Year')
 
-    # Prepare comparison graph data for periods A and B
+    # Aggregate periods A and B in one pass over filtered_traffic_str, then put them side by side
     group_cols = ['street_selection', group_by]
     group_clause = ", ".join(group_cols)
-    query_A = f"""
-    CREATE OR REPLACE TEMP TABLE df_period_grp_A AS 
-    SELECT 
-        {group_clause},
-        SUM(ped_total) AS ped_total,
-        SUM(bike_total) AS bike_total,
-        SUM(car_total) AS car_total,
-        SUM(heavy_total) AS heavy_total,
-    MIN(date_local) AS first_seen_A
-    FROM df_period_A
-    GROUP BY {group_clause}
-    ORDER BY first_seen_A
-    """
-
-    query_B = f"""
-    CREATE OR REPLACE TEMP TABLE df_period_grp_B AS 
-    SELECT 
-        {group_clause},
-        SUM(ped_total) AS ped_total_d,
-        SUM(bike_total) AS bike_total_d,
-        SUM(car_total) AS car_total_d,
-        SUM(heavy_total) AS heavy_total_d,
-    MIN(date_local) AS first_seen_B
-    FROM df_period_B
-    GROUP BY {group_clause}
-    ORDER BY first_seen_B
+    query = f"""
+    WITH grouped AS (
+        SELECT
+            {period_type_others} AS period,
+            {group_clause},
+            SUM(ped_total) AS ped_total,
+            SUM(bike_total) AS bike_total,
+            SUM(car_total) AS car_total,
+            SUM(heavy_total) AS heavy_total,
+        MIN(date_local) AS first_seen
+        FROM filtered_traffic_str
+        WHERE {period_type_others} IN (?, ?)
+        AND date_local >= ? AND date_local <= ?
+        GROUP BY period, {group_clause}
+    ),
+    period_A AS (
+        SELECT {group_clause}, ped_total, bike_total, car_total, heavy_total, first_seen AS first_seen_A
+        FROM grouped
+        WHERE period = ?
+    ),
+    period_B AS (
+        SELECT {group_clause}, ped_total AS ped_total_d, bike_total AS bike_total_d, car_total AS car_total_d,
+            heavy_total AS heavy_total_d, first_seen AS first_seen_B
+        FROM grouped
+        WHERE period = ?
+    )
+    SELECT *
+    FROM period_B
+    FULL OUTER JOIN period_A
+    USING ({group_by}, street_selection)
+    ORDER BY LEAST(first_seen_A, first_seen_B)
     """
+    params = [period_values_others[0], period_values_others[1], min_date, max_date, period_values_others[0], period_values_others[1]]
 
-    with db_lock:  # Ensure thread safety for writes
-        #df_period_grp_B = conn.execute(query_B).fetchdf()
-        conn.execute(query_A).fetchdf()
-        conn.execute(query_B).fetchdf()
-
-    # TODO: check if you need ORDER BY {group_by}
-    # Merge period A and period B
-    if period_type_others in [_('date'), _('year_month')]:
-        query = f"""
-        SELECT *
-        FROM df_period_grp_B
-        FULL OUTER JOIN df_period_grp_A
-        USING ({group_by}, street_selection)
-        ORDER BY {group_by}
-        """
-    else:
-        query = f"""
-        SELECT *
-        FROM df_period_grp_B
-        FULL OUTER JOIN df_period_grp_A
-        USING ({group_by}, street_selection)
-        """
-
-    df_avg_traffic_delta_AB = conn.execute(query).fetchdf()
+    with db_lock:
+        # Another session may have rebuilt filtered_traffic in the meantime, never cache its data under this key
+        if filter_key != filtered_traffic_key:
+            raise PreventUpdate
+        # Add selected street to filtered_traffic, under the same lock so no other session replaces it before the query
+        add_selected_street('filtered_traffic', id_street, street_name)
+        df_avg_traffic_delta_AB = conn.execute(query, params).fetchdf()
 
 
     # Draw graph
@@ -1485,37 +1530,24 @@ def comparison_chart(period_values_year, period_options_year,
         facet_col='street_selection',
         facet_col_spacing=0.04,
         category_orders={'street_selection': [street_name, 'All Streets']},
-        labels={'year': _('Year'), 'month': _('Month'), 'weekday': _('Week day'), 'day': _('Day'), 'hour': _('Hour')},
-        color_discrete_map={'ped_total': ADFC_lightblue, 'bike_total': ADFC_green, 'car_total': ADFC_orange, 'heavy_total': ADFC_crimson, 'ped_total_d': ADFC_lightblue, 'bike_total_d': ADFC_green, 'car_total_d': ADFC_orange, 'heavy_total_d': ADFC_crimson},
+        labels=dict(time_unit_labels, weekday=_('Week day')),
+        color_discrete_map=COMPARISON_COLORS,
     )
 
     # Apply graph layout updates
-    line_avg_delta_traffic.update_traces(selector={'name': 'ped_total_d'}, line={'dash': 'dash'})
-    line_avg_delta_traffic.update_traces(selector={'name': 'bike_total_d'}, line={'dash': 'dash'})
-    line_avg_delta_traffic.update_traces(selector={'name': 'car_total_d'}, line={'dash': 'dash'})
-    line_avg_delta_traffic.update_traces(selector={'name': 'heavy_total_d'}, line={'dash': 'dash'})
-    line_avg_delta_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace(street_name, street_name + _(' (segment:') + segment_id + ')')))
-    line_avg_delta_traffic.for_each_annotation(lambda a: a.update(text=a.text.split("=")[1]))
-    line_avg_delta_traffic.for_each_annotation(lambda a: a.update(text=a.text.replace('All Streets', _('All Streets'))))
-    line_avg_delta_traffic.update_layout({'plot_bgcolor': ADFC_palegrey,'paper_bgcolor': ADFC_palegrey})
-    line_avg_delta_traffic.update_layout(title_text=_('Period') + ' A : ' + label + ' - ' + period_values_others[0] + ' , ' + _('Period') + ' B (----): ' + label + ' - ' + period_values_others[1])
-    line_avg_delta_traffic.update_layout(yaxis_title=_('Absolute traffic count'))
-    line_avg_delta_traffic.update_layout(legend_title_text=_('Traffic Type'))
-    line_avg_delta_traffic.update_traces({'name': _('Pedestrians') + ' A'}, selector={'name': 'ped_total'})
-    line_avg_delta_traffic.update_traces({'name': _('Bikes') + ' A'}, selector={'name': 'bike_total'})
-    line_avg_delta_traffic.update_traces({'name': _('Cars') + ' A'}, selector={'name': 'car_total'})
-    line_avg_delta_traffic.update_traces({'name': _('Heavy') + ' A'}, selector={'name': 'heavy_total'})
-    line_avg_delta_traffic.update_traces({'name': _('Pedestrians') + ' B'}, selector={'name': 'ped_total_d'})
-    line_avg_delta_traffic.update_traces({'name': _('Bikes') + ' B'}, selector={'name': 'bike_total_d'})
-    line_avg_delta_traffic.update_traces({'name': _('Cars') + ' B'}, selector={'name': 'car_total_d'})
-    line_avg_delta_traffic.update_traces({'name': _('Heavy') + ' B'}, selector={'name': 'heavy_total_d'})
+    # Period B traces are dashed, both periods are named after the traffic type
+    line_avg_delta_traffic.for_each_trace(lambda t: t.update(name=traffic_type_labels[t.name.removesuffix('_d')] + ' B', line_dash='dash')
+                                          if t.name.endswith('_d') else t.update(name=traffic_type_labels[t.name] + ' A'))
+    line_avg_delta_traffic.for_each_annotation(lambda a: a.update(text=facet_title(a.text, street_name, street_name + segment_label + segment_id + ')'), font_size=14))
+    line_avg_delta_traffic.update_layout(plot_bgcolor=ADFC_palegrey, paper_bgcolor=ADFC_palegrey,
+                                         title_text=_('Period') + ' A : ' + label + ' - ' + period_values_others[0] + ' , ' + _('Period') + ' B (----): ' + label + ' - ' + period_values_others[1],
+                                         yaxis_title=_('Absolute traffic count'), legend_title_text=traffic_type_title)
     line_avg_delta_traffic.update_yaxes(matches=None)
     line_avg_delta_traffic.update_xaxes(matches=None)
-    line_avg_delta_traffic.for_each_yaxis(lambda yaxis: yaxis.update(showticklabels=True))
+    line_avg_delta_traffic.update_yaxes(showticklabels=True)
     line_avg_delta_traffic.update_xaxes(dtick = 1, tickformat=".0f")
-    for annotation in line_avg_delta_traffic.layout.annotations: annotation['font'] = {'size': 14}
 
-    return line_avg_delta_traffic, select_two_text, select_two_color
+    return json.loads(line_avg_delta_traffic.to_json())
 
 if __name__ == "__main__":
     app.run(debug=False)
\ No newline at end of file